@@ -1,71 +1,381 @@
 #!/usr/bin/python3
+import time
+#--startup_report measures from here, before the other imports
+STARTED = time.perf_counter()
 import argparse
 from datetime import datetime
 from getpass import getpass
-import json
-from mysql.connector import connect, Error
-import pandas as pd
-from pprint import pprint
-import requests
+import os
+import signal
+import threading
+from transitcodingchallenge.lazy import importReport, LazyModule
+from transitcodingchallenge.metrics import METRICS, Profiler
+from transitcodingchallenge.pipeline import iterQueued, Pipeline
+from transitcodingchallenge.snapshots import SnapshotStore
+from transitcodingchallenge.spatial import StationIndex
+from transitcodingchallenge.state import StateIndex
 import transitcodingchallenge.utils as utils
 
+#pandas, requests and mysql.connector are only imported once a step uses them
+pd = LazyModule("pandas")
+IMPORTED = time.perf_counter()
+
+#steps of a full run, in order. the command line runs one of them or all
+STEPS = ["lines", "routes", "arrivals"]
 
-def main(user_name, password, host, port, db_name):
-    startTime = datetime.now()
-    api = utils.ApiUtils()
-    sql = utils.SqlUtils(user_name=user_name,
-                            password=password,
-                            host=host,
-                            port=port,
-                            db_name=db_name)
 
+def refreshLines(api, sql):
+    """ Step 1: fetch the lines API, load it into a dataframe and into MySQL (the table is only written once) """
     # Step 1 - Task 1: load lines API results into variable
     lines_json = api.getLines()
+    if sql.station_resolver is not None:
+        sql.station_resolver.addLines(lines_json)
 
     # Step 1 - Task 2: load json into dataframe
     lines_df = sql.loadLinesDf(lines_json, ["line_name", "description"], 3)
 
     # Step 1 - Task3: load dataframe into MySQL
-    sql.loadTableNoOverwrite(lines_df, "line_name", user_name, password, host, port, db_name)
+    sql.loadTableNoOverwrite(lines_df, "line_name")
+    return lines_df
+
+
+def refreshRoutes(api, sql, refresh_mode="swap", stream_routes=False, batch_size=5000):
+    """ Step 2: fetch TransitViewAll, load it into a dataframe and refresh the route table.
+    With stream_routes the payload is decoded and written batch_size rows at a time into a shadow table that is
+    swapped in at the end, and only the first batch is returned. Streaming always swaps, so any other
+    refresh_mode is reported and not applied """
+    headers = utils.ROUTE_HEADERS
+    if stream_routes:
+        if refresh_mode != "swap":
+            print("Warning: --stream_routes always swaps the route table in, refresh_mode {} is not applied".format(refresh_mode))
+        #decoding runs ahead on its own thread while batches are written
+        batches = iterQueued(sql.iterRoutesBatches(api.iterRouteSegments(), headers, batch_size))
+        first_batch = streamBatches(sql, batches, "route")
+        return first_batch if first_batch is not None else pd.DataFrame(columns=headers)
 
     # Step 2 - Task1: load routes API results to variable (this contains all routes)
     routes_json = api.getRoutes()
 
     # Step 2 - Task2: load routes API results to dataframe
-    routes_df=sql.loadRoutesDf(routes_json, ["route", "vehicle_id", "direction", "destination"], 0)
+    routes_df=sql.loadRoutesDf(routes_json, headers, 0)
 
     # Step 2 - Task3: load dataframe into MySQL
-    sql.loadTableAllowOverwrite(routes_df, "route", user_name, password, host, port, db_name)
+    sql.loadTableAllowOverwrite(routes_df, "route", mode=refresh_mode)
+    return routes_df
+
 
+def refreshArrivals(api, sql, refresh_mode="swap", stations=None, stream_arrivals=False):
+    """ Step 3: fetch arrivals for the stations in the route table and refresh the line_metadata table.
+    stations defaults to getStations on the route table.
+    With stream_arrivals (swap mode only) responses are parsed and written to the shadow table as they arrive,
+    stations whose request failed are retried following sql.retry_policy, and only the first batch is returned.
+    If no station returns arrivals it falls back to loadLineMetaDf """
+    headers = ["line", "direction", "origin", "destination", "train_id"]
     # Step 3 - Task1: for route stations, load the line metadata API results to a table
-    stations = sql.getStations("route", user_name, password, host, port, db_name)
-    line_metadata_df = sql.loadLineMetaDf(["line", "direction", "origin", "destination", "train_id"], stations)
-    sql.loadTableAllowOverwrite(line_metadata_df, "line_metadata", user_name, password, host, port, db_name)
+    if stations is None:
+        stations = sql.getStations("route")
+    if stream_arrivals and refresh_mode == "swap":
+        #failed stations are retried before the shadow table is promoted
+        batches = iterQueued(sql.iterLineMetadataWithRetries(api, stations, headers))
+        first_batch = streamBatches(sql, batches, "line_metadata")
+        if first_batch is not None:
+            return first_batch
+    line_metadata_df = sql.loadLineMetaDf(headers, stations, api=api)
+    sql.loadTableAllowOverwrite(line_metadata_df, "line_metadata", mode=refresh_mode)
+    return line_metadata_df
+
+
+def readStations(api, sql, stations_from="route"):
+    """ Stations for a run that refreshes arrivals without refreshing routes first.
+    route reads the destinations already loaded in the route table. cache reads the last TransitViewAll response
+    kept in the response cache (see --cache_dir) however old it is. When that gives no stations TransitViewAll is fetched """
+    stations = []
+    if stations_from == "cache":
+        stations = sql.stationsFromRoutes(api.getCachedResponse(api.routes_url))
+    elif sql.tableExists("route"):
+        stations = sql.getStations("route")
+    if not stations:
+        print("No stations found in the {}, fetching TransitViewAll".format("response cache" if stations_from == "cache" else "route table"))
+        stations = sql.stationsFromRoutes(api.getRoutes())
+    return stations
+
+
+def streamBatches(sql, batches, table_name):
+    """ Writes an iterable of dataframes into table_name with streamTable. Returns the first batch, or None if there were none """
+    first_batch = []
+    def keepFirst(batches):
+        for batch in batches:
+            if not first_batch:
+                first_batch.append(batch)
+            yield batch
+    sql.streamTable(keepFirst(batches), table_name)
+    return first_batch[0] if first_batch else None
+
+
+def runPipeline(api, sql, refresh_mode="swap", stream_routes=False, batch_size=5000):
+    """ Runs the three steps as a dependency graph. Lines and Routes refresh concurrently, stations are read once
+    both are loaded (the station resolver learns from the Lines feed) and arrivals stream into the line_metadata
+    writer while later stations are still being fetched. Returns the pipeline results and stage timings """
+    pipeline = Pipeline()
+    pipeline.add("lines", lambda: refreshLines(api, sql))
+    pipeline.add("routes", lambda: refreshRoutes(api, sql, refresh_mode, stream_routes, batch_size))
+    pipeline.add("stations", lambda lines_df, routes_df: sql.getStations("route"), ["lines", "routes"])
+    pipeline.add("arrivals", lambda stations: refreshArrivals(api, sql, refresh_mode, stations, stream_arrivals=True),
+                 ["stations"])
+    results = pipeline.run()
+    for feed in ["lines", "routes", "arrivals"]:
+        METRICS.observe("refresh_seconds", pipeline.timings[feed], feed=feed)
+    return results, pipeline.timings
+
+
+def createApi(cache_dir=None):
+    """ Returns an ApiUtils on the shared HTTP client. cache_dir keeps the response cache on disk between runs """
+    if cache_dir is None:
+        return utils.ApiUtils()
+    return utils.ApiUtils(cache=utils.ResponseCache(path=cache_dir))
+
+
+def createSnapshotStore(snapshot_dir=None):
+    """ Parquet history of the route and line_metadata loads, when a directory is given (needs pyarrow) """
+    if snapshot_dir is None:
+        return None
+    return SnapshotStore(snapshot_dir)
+
+
+def createStateIndex(state_port=None):
+    """ In-memory vehicle and train index, served as JSON on http://127.0.0.1:<state_port>/ when a port is given """
+    state_index = StateIndex()
+    if state_port is not None:
+        state_index.serve(state_port)
+    return state_index
+
+
+def createStationIndex(api, station_locations=None):
+    """ Station locations used to tag vehicles with their nearest station. Read from station_locations (JSON or CSV)
+    when the file exists and lists stations, otherwise fetched from the SEPTA locations API and saved to
+    station_locations if given. Returns None (vehicles are not tagged) when no locations come back, so an empty
+    answer is never saved and the next run asks the API again """
+    if station_locations is not None and os.path.exists(station_locations):
+        station_index = StationIndex.fromFile(station_locations)
+        if len(station_index.names):
+            return station_index
+        print("{} lists no stations, fetching the station locations again".format(station_locations))
+    station_index = StationIndex.fromLocations(api.getStationLocations() or [])
+    if not len(station_index.names):
+        print("The locations API returned no stations, vehicles are not tagged with their nearest station")
+        return None
+    if station_locations is not None:
+        station_index.save(station_locations)
+    return station_index
+
+
+def createStationResolver(cache_dir=None):
+    """ Station mapping and negative cache used by getStations, saved next to the response cache when there is one """
+    if cache_dir is None:
+        return utils.StationResolver()
+    os.makedirs(cache_dir, exist_ok=True)
+    return utils.StationResolver(path=os.path.join(cache_dir, "stations.json"))
+
+
+def main(user_name, password, host, port, db_name, chunk_size=1000, load_data_infile=False, refresh_mode="swap",
+         cache_dir=None, stream_routes=False, batch_size=5000, sequential=False, snapshot_dir=None, state_port=None,
+         nearest_station=False, station_locations=None, steps=None, stations_from="route", startup_report=False):
+    """ Refreshes the steps listed in steps (defaults to all of STEPS). A full run goes through runPipeline (or one
+    step after the other with sequential). A partial run only runs its own steps, and arrivals without routes reads
+    its stations with readStations (stations_from). startup_report prints where the start up time went """
+    startTime = datetime.now()
+    steps = STEPS if steps is None else [step for step in STEPS if step in steps]
+    api = createApi(cache_dir)
+    sql = utils.SqlUtils(user_name=user_name,
+                            password=password,
+                            host=host,
+                            port=port,
+                            db_name=db_name,
+                            chunk_size=chunk_size,
+                            load_data_infile=load_data_infile,
+                            station_resolver=createStationResolver(cache_dir),
+                            snapshot_store=createSnapshotStore(snapshot_dir),
+                            state_index=createStateIndex(state_port),
+                            station_index=createStationIndex(api, station_locations)
+                                          if nearest_station and "routes" in steps else None)
+
+    if startup_report:
+        print("Startup: {:.0f}ms to the first step, {:.0f}ms of it in module imports".format(
+            (time.perf_counter() - STARTED) * 1000, (IMPORTED - STARTED) * 1000))
+    lines_df, routes_df, line_metadata_df = None, None, None
+    if steps == STEPS and not sequential:
+        results, timings = runPipeline(api, sql, refresh_mode, stream_routes, batch_size)
+        lines_df, routes_df, line_metadata_df = results["lines"], results["routes"], results["arrivals"]
+        print("Stage timings: " + ", ".join("{} {:.2f}s".format(stage, seconds) for stage, seconds in timings.items()))
+    else:
+        if "lines" in steps:
+            with METRICS.timer("refresh_seconds", feed="lines"):
+                lines_df = refreshLines(api, sql)
+        if "routes" in steps:
+            with METRICS.timer("refresh_seconds", feed="routes"):
+                routes_df = refreshRoutes(api, sql, refresh_mode, stream_routes, batch_size)
+        if "arrivals" in steps:
+            with METRICS.timer("refresh_seconds", feed="arrivals"):
+                stations = None if "routes" in steps else readStations(api, sql, stations_from)
+                line_metadata_df = refreshArrivals(api, sql, refresh_mode, stations)
+
+    #hand the pooled MySQL connections back to the server
+    sql.close()
 
     # Let's end with printing some stuff so we can see the output of our hard work
     pd.set_option('display.max_columns', None)
-    if not(lines_df.empty):
+    if lines_df is not None and not(lines_df.empty):
         print("------Top 5 rows in Lines DataFrame-----")
         print(lines_df.head(5))
-    if not(routes_df.empty):
+    if routes_df is not None and not(routes_df.empty):
         print("------Top 5 rows in Routes DataFrame-----")
         print(routes_df.head(5))
-    if not(line_metadata_df.empty):
+    if line_metadata_df is not None and not(line_metadata_df.empty):
         print("------Top 5 rows in Line Metadata DataFrame-----")
         print(line_metadata_df.head(5))
 
+    api_summary = api.client.summary()
+    print("\nAPI calls: {} ({} retries), {:.2f}s total latency, {} bytes".format(
+        api_summary["calls"], api_summary["retries"], api_summary["seconds"], api_summary["bytes"]))
+    if api.cache is not None:
+        print("Response cache: {}".format(api.cache.stats()))
+    print("Stations: {}".format(sql.station_resolver.stats()))
+    print("State index: {}".format(sql.state_index.stats()))
+    if startup_report:
+        print(importReport())
     print("\n##### Script Runtime for SEPTA Transit Coding Challenge - ", datetime.now() - startTime, "#####")
 
+
+def runDaemon(user_name, password, host, port, db_name, chunk_size=1000, load_data_infile=False, refresh_mode="swap",
+              lines_interval=3600, routes_interval=10, arrivals_interval=30, cache_dir=None, metrics_json=None,
+              stream_routes=False, batch_size=5000, snapshot_dir=None, state_port=None, nearest_station=False,
+              station_locations=None, steps=None, stations_from="route"):
+    """ Keeps the tables fresh from one long running process.
+    Each feed is refreshed on its own interval (seconds) reusing the same HTTP session and MySQL pool.
+    Feeds run one at a time so refresh cycles never overlap. When a refresh takes longer than its interval the
+    missed runs are skipped and the feed waits a full interval after it finishes before running again.
+    SIGTERM and SIGINT stop the loop after the running refresh completes.
+    metrics_json is rewritten with the current metrics after every refresh.
+    steps limits the feeds refreshed (defaults to all of STEPS). Arrivals without routes reads its stations with
+    readStations (stations_from) """
+    steps = STEPS if steps is None else [step for step in STEPS if step in steps]
+    api = createApi(cache_dir)
+    sql = utils.SqlUtils(user_name=user_name,
+                            password=password,
+                            host=host,
+                            port=port,
+                            db_name=db_name,
+                            chunk_size=chunk_size,
+                            load_data_infile=load_data_infile,
+                            station_resolver=createStationResolver(cache_dir),
+                            snapshot_store=createSnapshotStore(snapshot_dir),
+                            state_index=createStateIndex(state_port),
+                            station_index=createStationIndex(api, station_locations)
+                                          if nearest_station and "routes" in steps else None)
+
+    stop = threading.Event()
+    def requestStop(signum, frame):
+        print("Received signal {}, stopping after the current refresh".format(signum))
+        stop.set()
+    signal.signal(signal.SIGTERM, requestStop)
+    signal.signal(signal.SIGINT, requestStop)
+
+    feeds = [
+        ("lines", lambda: refreshLines(api, sql), lines_interval),
+        ("routes", lambda: refreshRoutes(api, sql, refresh_mode, stream_routes, batch_size), routes_interval),
+        ("arrivals", lambda: refreshArrivals(api, sql, refresh_mode,
+                                             None if "routes" in steps else readStations(api, sql, stations_from)),
+         arrivals_interval)
+    ]
+    feeds = [feed for feed in feeds if feed[0] in steps]
+    next_run = {name: time.monotonic() for name, refresh, interval in feeds}
+
+    while not stop.is_set():
+        for name, refresh, interval in feeds:
+            if stop.is_set() or next_run[name] > time.monotonic():
+                continue
+            started = time.monotonic()
+            try:
+                refresh()
+            except Exception as e:
+                #keep the daemon alive. the feed is retried on its next interval
+                print("{} refresh failed: {}".format(name, e))
+            finished = time.monotonic()
+            elapsed = finished - started
+            METRICS.observe("refresh_seconds", elapsed, feed=name)
+            if metrics_json is not None:
+                METRICS.toJson(metrics_json)
+            if elapsed > interval:
+                print("{} refresh took {:.1f}s, longer than its {}s interval. Skipping missed runs".format(
+                    name, elapsed, interval))
+                next_run[name] = finished + interval
+            else:
+                next_run[name] = max(next_run[name] + interval, finished)
+        stop.wait(max(min(next_run.values()) - time.monotonic(), 0))
+
+    sql.close()
+    print("Daemon stopped")
+
+
 if __name__ == "__main__":
 
 
     parser = argparse.ArgumentParser(description='Runs through All Steps for Problem 1 of the Data Analyst Coding Challenge')
+    parser.add_argument("command", nargs="?", choices=STEPS + ["all"], default="all",
+                        help="Step to run: lines, routes, arrivals or all of them (default)")
     parser.add_argument("-us", "--mysql_username", dest="user_name", help="Username for accessing MySQL Server", required=False)
     parser.add_argument("-pw", "--mysql_password", dest="password", help="Username for accessing MySQL Server", required=False)
     parser.add_argument("-ho", "--mysql_host", dest="host", help="Host Name for accessing MySQL Server", default="localhost")
     parser.add_argument("-po", "--mysql_port", dest="port", help="Host Name for accessing MySQL Server", default="3306")
     parser.add_argument("-db", "--mysql_database", dest="db_name", help="Database Name for accessing MySQL Server", default="septa_transit")
+    parser.add_argument("--chunk_size", dest="chunk_size", type=int, help="Rows sent per executemany batch", default=1000)
+    parser.add_argument("--load_data_infile", dest="load_data_infile", action="store_true",
+                        help="Bulk load tables with LOAD DATA LOCAL INFILE (server must allow local_infile)")
+    parser.add_argument("--daemon", dest="daemon", action="store_true",
+                        help="Keep running and refresh each feed on its own interval until SIGTERM")
+    parser.add_argument("--lines_interval", dest="lines_interval", type=float, default=3600,
+                        help="Seconds between lines refreshes in daemon mode")
+    parser.add_argument("--routes_interval", dest="routes_interval", type=float, default=10,
+                        help="Seconds between TransitView refreshes in daemon mode")
+    parser.add_argument("--arrivals_interval", dest="arrivals_interval", type=float, default=30,
+                        help="Seconds between Arrivals refreshes in daemon mode")
+    parser.add_argument("--cache_dir", dest="cache_dir", default=None,
+                        help="Directory for the on-disk API response cache (in-memory only if not set)")
+    parser.add_argument("--metrics_json", dest="metrics_json", default=None,
+                        help="Write per stage metrics (API latency, parse time, SQL round trips) as JSON to this file")
+    parser.add_argument("--metrics_port", dest="metrics_port", type=int, default=None,
+                        help="Serve Prometheus metrics on http://127.0.0.1:<port>/metrics")
+    parser.add_argument("--profile", dest="profile", action="store_true", help="Run under cProfile and print the hot spots")
+    parser.add_argument("--profile_output", dest="profile_output", default=None, help="Also save the cProfile stats to this file")
+    parser.add_argument("--refresh_mode", dest="refresh_mode", choices=["swap", "drop", "upsert"], default="swap",
+                        help="How the route and line_metadata tables are refreshed (see loadTableAllowOverwrite)")
+    parser.add_argument("--stream_routes", dest="stream_routes", action="store_true",
+                        help="Decode TransitViewAll incrementally and load the route table in batches (uses ijson when installed). "
+                             "Only works with --refresh_mode swap. "
+                             "With ijson the response is not kept in the response cache, so --stations_from cache finds nothing")
+    parser.add_argument("--batch_size", dest="batch_size", type=int, default=5000,
+                        help="Rows per batch when --stream_routes is set")
+    parser.add_argument("--snapshot_dir", dest="snapshot_dir", default=None,
+                        help="Also append every route and line_metadata load to Parquet files under this directory (needs pyarrow)")
+    parser.add_argument("--state_port", dest="state_port", type=int, default=None,
+                        help="Serve the latest vehicle and train state as JSON on this local port")
+    parser.add_argument("--nearest_station", dest="nearest_station", action="store_true",
+                        help="Tag every vehicle with its nearest Regional Rail station")
+    parser.add_argument("--station_locations", dest="station_locations", default=None,
+                        help="Station locations file (JSON or CSV with name, lat, lng). Fetched from the locations API and saved here if missing")
+    parser.add_argument("--sequential", dest="sequential", action="store_true",
+                        help="Run Lines, Routes and Arrivals one after the other instead of as a pipeline")
+    parser.add_argument("--stations_from", dest="stations_from", choices=["route", "cache"], default="route",
+                        help="Where the arrivals command reads its stations: the route table already in MySQL, or the last "
+                             "TransitViewAll response in --cache_dir. Falls back to fetching TransitViewAll")
+    parser.add_argument("--startup_report", dest="startup_report", action="store_true",
+                        help="Print the start up time and the time spent in each deferred import "
+                             "(python -X importtime main.py ... shows every module)")
     args = parser.parse_args()
+    if args.stream_routes and args.refresh_mode != "swap":
+        parser.error("--stream_routes always swaps the route table in and cannot be combined with --refresh_mode {}".format(
+            args.refresh_mode))
+    steps = STEPS if args.command == "all" else [args.command]
 
     if args.user_name is None:
         user = getpass("Enter MySQL username: ")
@@ -77,4 +387,20 @@ if __name__ == "__main__":
     else:
         pw = args.password
 
-    main(user, pw, args.host, args.port, args.db_name)
+    if args.metrics_port is not None:
+        METRICS.serve(args.metrics_port)
+
+    with Profiler(args.profile, args.profile_output):
+        if args.daemon:
+            runDaemon(user, pw, args.host, args.port, args.db_name, args.chunk_size, args.load_data_infile, args.refresh_mode,
+                      args.lines_interval, args.routes_interval, args.arrivals_interval, args.cache_dir, args.metrics_json,
+                      args.stream_routes, args.batch_size, args.snapshot_dir, args.state_port, args.nearest_station,
+                      args.station_locations, steps, args.stations_from)
+        else:
+            main(user, pw, args.host, args.port, args.db_name, args.chunk_size, args.load_data_infile, args.refresh_mode,
+                 args.cache_dir, args.stream_routes, args.batch_size, args.sequential, args.snapshot_dir,
+                 args.state_port, args.nearest_station, args.station_locations, steps, args.stations_from,
+                 args.startup_report)
+
+    if args.metrics_json is not None:
+        METRICS.toJson(args.metrics_json)
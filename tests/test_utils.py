@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+""" Unit tests for the parts of utils.py that do not need a MySQL server: column widening, CREATE TABLE generation
+and the upsert diff. Run with python3 -m pytest tests/ (or python3 -m unittest discover tests) """
+from contextlib import contextmanager
+import unittest
+import pandas as pd
+from transitcodingchallenge.utils import SqlUtils, widenColumnType
+
+
+class FakeCursor():
+    def __init__(self, connection):
+        """ Records the statements run through it on its connection """
+        self.connection = connection
+
+    def execute(self, statement, params = None):
+        self.connection.statements.append((statement, params))
+
+    def executemany(self, statement, rows):
+        self.connection.statements.append((statement, list(rows)))
+
+    def close(self):
+        return
+
+
+class FakeConnection():
+    def __init__(self):
+        """ Stands in for a pooled mysql.connector connection """
+        self.statements = []
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        return
+
+
+class FakeSqlUtils(SqlUtils):
+    def __init__(self, has_modified_at = False, stored_keys = None):
+        """ SqlUtils that captures the SQL upsertTable generates instead of sending it.
+        has_modified_at is what tableHasColumn answers. stored_keys are the rows readTable returns """
+        super().__init__(None, None, None, None, None)
+        self.fake_connection = FakeConnection()
+        self.has_modified_at = has_modified_at
+        self.stored_keys = stored_keys or []
+        self.swapped = []
+        self.migrated = []
+
+    @contextmanager
+    def connection(self, timeout = 30):
+        yield self.fake_connection
+
+    def tableHasColumn(self, table_name, column_name):
+        return self.has_modified_at
+
+    def migrateTable(self, dataframe, table_name, primary_key = None, schema_table = None):
+        self.migrated.append(table_name)
+        return []
+
+    def readTable(self, table_name, user_name = None, password = None, host = None, port = None, db_name = None,
+                  select_statement = None, toPrint = True):
+        return self.stored_keys
+
+    def swapTable(self, dataframe, table_name, primary_key = None):
+        self.swapped.append((dataframe, table_name, primary_key))
+
+    def written(self, keyword):
+        """ Returns the rows passed to the executemany calls whose statement starts with keyword """
+        return [row for statement, rows in self.fake_connection.statements if statement.startswith(keyword)
+                for row in rows]
+
+
+def lineMetadataDf(rows):
+    return pd.DataFrame(rows, columns=["line", "train_id", "station", "status"])
+
+
+class WidenColumnTypeTest(unittest.TestCase):
+    def test_same_type_is_kept(self):
+        self.assertEqual(widenColumnType("INT", "INT"), "INT")
+
+    def test_int_widens_to_bigint(self):
+        self.assertEqual(widenColumnType("INT", "BIGINT"), "BIGINT")
+
+    def test_bigint_is_never_narrowed(self):
+        self.assertEqual(widenColumnType("BIGINT", "INT"), "BIGINT")
+        self.assertEqual(widenColumnType("bigint(20)", "INT"), "BIGINT")
+
+    def test_display_width_is_kept(self):
+        self.assertEqual(widenColumnType("int(11)", "INT"), "int(11)")
+
+    def test_enum_values_are_merged(self):
+        self.assertEqual(widenColumnType("ENUM('N','S')", "ENUM('S','E')"), "ENUM('N','S','E')")
+
+    def test_enum_values_with_quotes(self):
+        self.assertEqual(widenColumnType("ENUM('a')", "ENUM('it''s')"), "ENUM('a','it''s')")
+
+    def test_varchar_takes_the_longer_length(self):
+        self.assertEqual(widenColumnType("VARCHAR(10)", "VARCHAR(32)"), "VARCHAR(32)")
+        self.assertEqual(widenColumnType("varchar(32)", "VARCHAR(10)"), "VARCHAR(32)")
+
+    def test_varchar_fits_enum_values(self):
+        self.assertEqual(widenColumnType("VARCHAR(4)", "ENUM('Northbound')"), "VARCHAR(10)")
+
+    def test_text_is_kept(self):
+        self.assertEqual(widenColumnType("TEXT", "VARCHAR(16)"), "TEXT")
+
+    def test_blob_is_converted(self):
+        self.assertEqual(widenColumnType("BLOB", "VARCHAR(16)"), "VARCHAR(16)")
+        self.assertEqual(widenColumnType("blob", "BIGINT"), "BIGINT")
+
+
+class CreateTableStatementTest(unittest.TestCase):
+    def setUp(self):
+        self.sql = SqlUtils(None, None, None, None, None)
+
+    def test_single_column(self):
+        self.assertEqual(self.sql.createTableStatement("lines", ["line_name"]),
+                         "CREATE TABLE IF NOT EXISTS `lines` (`line_name` BLOB)")
+
+    def test_column_types(self):
+        self.assertEqual(self.sql.createTableStatement("t", ["a", "b"], column_types={"a": "INT"}),
+                         "CREATE TABLE IF NOT EXISTS `t` (`a` INT, `b` BLOB)")
+
+    def test_primary_key(self):
+        statement = self.sql.createTableStatement("route", ["route", "vehicle_id", "destination"],
+                                                  primary_key=["route", "vehicle_id"],
+                                                  column_types={"route": "VARCHAR(8)", "vehicle_id": "BIGINT"})
+        self.assertEqual(statement, "CREATE TABLE IF NOT EXISTS `route` (`route` VARCHAR(8), `vehicle_id` BIGINT, "
+                                    "`destination` BLOB, PRIMARY KEY (`route`, `vehicle_id`))")
+
+    def test_blob_key_gets_a_prefix(self):
+        statement = self.sql.createTableStatement("t", ["a"], primary_key=["a"])
+        self.assertTrue(statement.endswith("PRIMARY KEY (`a`(255)))"))
+
+    def test_indexes(self):
+        statement = self.sql.createTableStatement("route", ["route", "destination"], indexes=[["destination"]],
+                                                  column_types={"route": "VARCHAR(8)", "destination": "TEXT"})
+        self.assertEqual(statement, "CREATE TABLE IF NOT EXISTS `route` (`route` VARCHAR(8), `destination` TEXT, "
+                                    "INDEX `idx_destination` (`destination`(255)))")
+
+    def test_index_covered_by_the_primary_key_is_skipped(self):
+        statement = self.sql.createTableStatement("t", ["a", "b"], primary_key=["a", "b"], indexes=[["a"], ["b"]],
+                                                  column_types={"a": "INT", "b": "INT"})
+        self.assertNotIn("idx_a", statement)
+        self.assertIn("INDEX `idx_b` (`b`)", statement)
+
+
+class UpsertTableTest(unittest.TestCase):
+    def test_first_load_rebuilds_the_table(self):
+        sql = FakeSqlUtils()
+        counts = sql.upsertTable(lineMetadataDf([["L1", "1", "A", "On Time"]]), "line_metadata")
+        self.assertEqual(counts, {"inserted": 1, "updated": 0, "deleted": 0})
+        dataframe, table_name, primary_key = sql.swapped[0]
+        self.assertEqual(table_name, "line_metadata")
+        self.assertEqual(primary_key, ["line", "train_id"])
+        self.assertIn("modified_at", dataframe.columns)
+        self.assertEqual(sql.fake_connection.statements, [])
+
+    def test_only_inserted_changed_and_deleted_keys_are_written(self):
+        sql = FakeSqlUtils()
+        sql.upsertTable(lineMetadataDf([["L1", "1", "A", "On Time"], ["L1", "2", "B", "On Time"],
+                                        ["L2", "3", "C", "On Time"]]), "line_metadata")
+        counts = sql.upsertTable(lineMetadataDf([["L1", "1", "A", "On Time"], ["L1", "2", "B", "5 min"],
+                                                 ["L2", "4", "D", "On Time"]]), "line_metadata")
+        self.assertEqual(counts, {"inserted": 1, "updated": 1, "deleted": 1})
+        upserted = sql.written("INSERT")
+        self.assertEqual([row[:4] for row in upserted], [("L1", "2", "B", "5 min"), ("L2", "4", "D", "On Time")])
+        self.assertEqual(sql.written("DELETE"), [("L2", "3")])
+        self.assertEqual(sql.fake_connection.commits, 1)
+
+    def test_upsert_statement(self):
+        sql = FakeSqlUtils(has_modified_at=True)
+        sql.snapshots["line_metadata"] = {}
+        sql.upsertTable(lineMetadataDf([["L1", "1", "A", "On Time"]]), "line_metadata")
+        statement = sql.fake_connection.statements[0][0]
+        self.assertTrue(statement.startswith("INSERT INTO `line_metadata` (`line`,`train_id`,`station`,`status`,"
+                                             "`first_seen`,`modified_at`) VALUES (%s,%s,%s,%s,%s,%s)"))
+        self.assertIn("`station` <=> VALUES(`station`) AND `status` <=> VALUES(`status`)", statement)
+        self.assertNotIn("`line` = VALUES", statement)
+
+    def test_unchanged_load_writes_nothing(self):
+        sql = FakeSqlUtils()
+        df = lineMetadataDf([["L1", "1", "A", "On Time"]])
+        sql.upsertTable(df, "line_metadata")
+        counts = sql.upsertTable(df, "line_metadata")
+        self.assertEqual(counts, {"inserted": 0, "updated": 0, "deleted": 0})
+        self.assertEqual(sql.written("INSERT") + sql.written("DELETE"), [])
+
+    def test_restart_diffs_against_the_stored_keys(self):
+        #a new process has no snapshot but the table already has modified_at
+        sql = FakeSqlUtils(has_modified_at=True, stored_keys=[("L1", "1"), (b"L2", b"3")])
+        counts = sql.upsertTable(lineMetadataDf([["L1", "1", "A", "On Time"], ["L1", "2", "B", "On Time"]]),
+                                 "line_metadata")
+        self.assertEqual(counts, {"inserted": 1, "updated": 1, "deleted": 1})
+        self.assertEqual(sql.swapped, [])
+        self.assertEqual(sql.migrated, ["line_metadata"])
+        self.assertEqual(len(sql.written("INSERT")), 2)
+        self.assertEqual(sql.written("DELETE"), [("L2", "3")])
+        self.assertEqual(set(sql.snapshots["line_metadata"]), {("L1", "1"), ("L1", "2")})
+
+    def test_skipped_columns_are_not_written(self):
+        sql = FakeSqlUtils(has_modified_at=True)
+        sql.snapshots["route"] = {}
+        df = pd.DataFrame([["17", 100, "Northbound", "A", 39.9, -75.1]],
+                          columns=["route", "vehicle_id", "direction", "destination", "lat", "lng"])
+        sql.upsertTable(df, "route")
+        statement = sql.fake_connection.statements[0][0]
+        self.assertNotIn("`lat`", statement)
+        self.assertNotIn("`lng`", statement)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,381 @@
+#!/usr/bin/python3
+""" Offline benchmark for the SEPTA pipeline.
+
+Serves recorded or synthetic Lines, TransitViewAll and Arrivals payloads from a local HTTP stub with a
+configurable latency, loads them into MySQL or a SQLite stand-in, and times each stage separately
+(fetch, parse, insert, getStations). Results are written as JSON so runs can be compared across changes.
+
+    python3 -m transitcodingchallenge.benchmark --scale 1 10 100 --latency 0.05 --output bench.json
+    python3 -m transitcodingchallenge.benchmark --record fixtures/      ( save live payloads as fixtures )
+    python3 -m transitcodingchallenge.benchmark --fixtures fixtures/ --db mysql -us root -pw secret
+"""
+import argparse
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import time
+from urllib.parse import unquote
+from transitcodingchallenge.common import serveHttp
+from transitcodingchallenge.spatial import StationIndex
+import transitcodingchallenge.utils as utils
+
+
+LINES_HEADERS = ["line_name", "description"]
+LINE_METADATA_HEADERS = ["line", "direction", "origin", "destination", "train_id"]
+
+#stations that answer in the synthetic Arrivals feed. bus destinations ending in " Transportation Center" map onto them
+STATIONS = ["Frankford", "Norristown", "Olney", "Fern Rock", "Jenkintown", "Chestnut Hill", "Darby", "Wissahickon",
+            "Suburban Station", "30th Street Station", "Temple University", "Glenside", "Lansdale", "Paoli", "Trenton"]
+BUS_DESTINATIONS = ["Center City", "Penn's Landing", "Broad-Erie", "Cheltenham-Ogontz", "Parx Casino", "Plymouth Meeting",
+                    "Bethlehem Pike", "Oxford Circle", "Frankford-Dyre", "Roxborough", "Manayunk", "Germantown"]
+RAIL_LINES = ["Airport", "Chestnut Hill East", "Chestnut Hill West", "Cynwyd", "Fox Chase", "Lansdale/Doylestown",
+              "Media/Elwyn", "Manayunk/Norristown", "Paoli/Thorndale", "Trenton", "Warminster", "West Trenton", "Wilmington/Newark"]
+DIRECTIONS = ["NorthBound", "SouthBound", "EastBound", "WestBound"]
+
+
+def makeLinesPayload():
+    """ Returns a synthetic lines payload shaped like the septastats lines endpoint """
+    return {
+        "status": {"code": "200", "message": "OK", "source": "synthetic"},
+        "meta": {"generated": datetime.now().isoformat(), "count": str(len(RAIL_LINES))},
+        "paging": {"page": "1", "pages": "1", "size": str(len(RAIL_LINES))},
+        "data": {line: "{} Line".format(line) for line in RAIL_LINES}
+    }
+
+
+def makeRoutesPayload(scale = 1, routes = 120, vehicles_per_route = 12, seed = 0):
+    """ Returns a synthetic TransitViewAll payload with routes * vehicles_per_route * scale vehicles """
+    generator = random.Random(seed)
+    destinations = ["{} Transportation Center".format(station) for station in STATIONS] + BUS_DESTINATIONS
+    vehicle_id = 1000
+    payload = {"routes": []}
+    for route in range(1, routes + 1):
+        segments = []
+        for i in range(vehicles_per_route * scale):
+            vehicle_id += 1
+            segments.append({
+                "lat": "{:.6f}".format(39.95 + generator.uniform(-0.2, 0.2)),
+                "lng": "{:.6f}".format(-75.16 + generator.uniform(-0.25, 0.25)),
+                "label": str(vehicle_id),
+                "VehicleID": str(vehicle_id),
+                "BlockID": str(generator.randint(1000, 9999)),
+                "Direction": generator.choice(DIRECTIONS),
+                "destination": generator.choice(destinations),
+                "Offset": str(generator.randint(0, 5)),
+                "heading": generator.randint(0, 359),
+                "late": generator.randint(-2, 20),
+                "trip": str(generator.randint(100000, 999999))
+            })
+        payload["routes"].append({str(route): segments})
+    return payload
+
+
+def makeStationLocations(seed = 0):
+    """ Returns a synthetic locations API answer placing each of STATIONS around Center City """
+    generator = random.Random(seed)
+    return [{"location_id": str(i), "location_name": station, "location_type": "rail_stations",
+             "location_lat": "{:.6f}".format(39.95 + generator.uniform(-0.2, 0.2)),
+             "location_lon": "{:.6f}".format(-75.16 + generator.uniform(-0.25, 0.25))}
+            for i, station in enumerate(STATIONS)]
+
+
+def makeArrivalsPayload(station, trains = 5, seed = 0):
+    """ Returns a synthetic Arrivals payload for station. Unknown stations get the empty [[], []] answer """
+    key = "{} Departures: {}".format(station, datetime.now().strftime("%B %d, %Y, %I:%M %p"))
+    if station not in STATIONS:
+        return {key: [[], []]}
+    generator = random.Random("{}{}".format(seed, station))
+    directions = []
+    for direction in ["Northbound", "Southbound"]:
+        arrivals = []
+        for i in range(trains):
+            arrivals.append({
+                "direction": direction[0],
+                "path": "R{}{}".format(generator.randint(1, 8), direction[0]),
+                "train_id": str(generator.randint(200, 9999)),
+                "origin": generator.choice(STATIONS),
+                "destination": generator.choice(STATIONS),
+                "line": generator.choice(RAIL_LINES),
+                "status": "On Time",
+                "service_type": "LOCAL",
+                "next_station": None,
+                "sched_time": "2021-03-20 10:{:02d}:00.000".format(i * 10),
+                "depart_time": "2021-03-20 10:{:02d}:00.000".format(i * 10),
+                "track": str(generator.randint(1, 6)),
+                "track_change": None,
+                "platform": "",
+                "platform_change": None
+            })
+        directions.append({direction: arrivals})
+    return {key: directions}
+
+
+def scaleRoutesPayload(routes_json, scale):
+    """ Repeats every vehicle of a recorded TransitViewAll payload scale times, giving the copies new vehicle ids """
+    if scale == 1:
+        return routes_json
+    payload = {"routes": []}
+    for route_dict in routes_json["routes"]:
+        for route_id, segments in route_dict.items():
+            scaled = []
+            for copy in range(scale):
+                for segment in segments:
+                    scaled.append(dict(segment, VehicleID="{}{:03d}".format(segment.get("VehicleID"), copy)))
+            payload["routes"].append({route_id: scaled})
+    return payload
+
+
+def recordFixtures(directory, api = None):
+    """ Saves the live Lines, TransitViewAll and Arrivals payloads to directory for offline runs """
+    api = api if api is not None else utils.ApiUtils(cache=False)
+    os.makedirs(directory, exist_ok=True)
+    lines_json = api.getLines()
+    routes_json = api.getRoutes()
+    sql = utils.SqlUtils(None, None, None, None, None)
+    routes_df = sql.loadRoutesDf(routes_json, utils.ROUTE_HEADERS, 0)
+    #pick the stations exactly the way the pipeline does
+    stations = sql.resolveStations(routes_df["destination"].dropna().tolist())
+    responses, failed_stations = api.getLineMetadataMany(sorted(stations))
+    for name, payload in [("lines", lines_json), ("routes", routes_json),
+                          ("arrivals", {station: response for station, response in responses if response is not None})]:
+        with open(os.path.join(directory, name + ".json"), "w", encoding="utf-8") as fixture:
+            json.dump(payload, fixture)
+    print("Recorded fixtures for {} stations to {}".format(len(responses) - len(failed_stations), directory))
+
+
+def loadFixtures(directory):
+    """ Returns the (lines, routes, arrivals) payloads saved by recordFixtures """
+    fixtures = []
+    for name in ["lines", "routes", "arrivals"]:
+        with open(os.path.join(directory, name + ".json"), encoding="utf-8") as fixture:
+            fixtures.append(json.load(fixture))
+    return tuple(fixtures)
+
+
+class StubServer():
+    def __init__(self, lines_json, routes_json, arrivals = None, latency = 0.0):
+        """ Local HTTP server answering the Lines, TransitViewAll and Arrivals endpoints.
+        arrivals maps station name to payload. Stations not in it get a synthetic answer.
+        latency is the seconds each response is delayed by """
+        self.payloads = {
+            "/lines": json.dumps(lines_json).encode("utf-8"),
+            "/TransitViewAll/": json.dumps(routes_json).encode("utf-8"),
+            "/locations/": json.dumps(makeStationLocations()).encode("utf-8")
+        }
+        self.arrivals = arrivals or {}
+        self.latency = latency
+        self.server = None
+
+    def respond(self, path):
+        """ Returns the (body, content type) answering path, or None when there is no payload for it """
+        time.sleep(self.latency)
+        body = self.payloads.get(path.split("get_locations.php")[0])
+        if body is None and path.startswith("/Arrivals/"):
+            station = unquote(path[len("/Arrivals/"):].split("/")[0])
+            body = json.dumps(self.arrivals.get(station) or makeArrivalsPayload(station)).encode("utf-8")
+        return (body, "application/json") if body is not None else None
+
+    def start(self):
+        """ Starts serving on a free local port. Returns the base url """
+        #keep-alive like the real endpoints, so the pooled client reuses its connections
+        self.server = serveHttp(self.respond, 0, name="benchmark-stub", protocol_version="HTTP/1.1")
+        return "http://127.0.0.1:{}".format(self.server.server_port)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def api(self, base_url):
+        """ Returns an ApiUtils pointed at this stub, with its own client and no response cache """
+        return utils.ApiUtils(client=utils.HttpClient(requests_per_second=None), cache=False,
+                              lines_url=base_url + "/lines",
+                              routes_url=base_url + "/TransitViewAll/",
+                              arrivals_url=base_url + "/Arrivals/",
+                              locations_url=base_url + "/locations/get_locations.php")
+
+
+class SqliteSqlUtils(utils.SqlUtils):
+    def __init__(self, path = ":memory:", chunk_size = 1000, station_resolver = None):
+        """ SQLite stand-in for SqlUtils so the insert and getStations stages can be timed without a MySQL server.
+        Covers the statements the benchmark runs: creating tables, inserting, reading and dropping """
+        super().__init__(None, None, None, None, path, chunk_size = chunk_size, station_resolver = station_resolver)
+        self.placeholder = "?"
+        self.sqlite_connection = sqlite3.connect(path, check_same_thread=False)
+
+    def getPool(self):
+        return None
+
+    @contextmanager
+    def connection(self, timeout = 30):
+        """ Every caller shares the single SQLite connection """
+        with self.pool_lock:
+            yield self.sqlite_connection
+
+    def close(self):
+        self.sqlite_connection.close()
+
+    def tableExists(self, table_name, user_name = None, password = None, host = None, port = None, db_name = None):
+        with self.connection() as myconnection:
+            found = myconnection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                         (table_name,)).fetchone()
+        return found is not None
+
+    def inferColumnTypes(self, dataframe, enum_columns = ()):
+        #SQLite has no ENUM type
+        return {column: "TEXT" if column_type.startswith("ENUM") else column_type
+                for column, column_type in super().inferColumnTypes(dataframe, enum_columns).items()}
+
+    def createTable(self, dataframe, table_name, user_name = None, password = None, host = None, port = None, db_name = None,
+                    primary_key = None, schema_table = None):
+        """ Creates the table, then its secondary indexes (SQLite does not take INDEX clauses in CREATE TABLE) """
+        schema = utils.TABLE_SCHEMAS.get(schema_table or table_name, {})
+        column_types = self.inferColumnTypes(dataframe, schema.get("enums", ()))
+        with self.connection() as myconnection:
+            myconnection.execute(self.createTableStatement(table_name, dataframe.columns.tolist(), primary_key, column_types))
+            for index in [index for index in schema.get("indexes", []) if set(index) <= set(dataframe.columns)]:
+                myconnection.execute("CREATE INDEX IF NOT EXISTS `{0}_{1}` ON `{0}` ({2})".format(
+                    table_name, utils.indexName(index), ", ".join("`{}`".format(column) for column in index)))
+            myconnection.commit()
+
+    def migrateTable(self, dataframe, table_name, primary_key = None, schema_table = None):
+        #SQLite columns take values of any length, so there is nothing to widen
+        return []
+
+    def promoteShadowTable(self, table_name):
+        """ Replaces the table with <table_name>_new (SQLite has no multi table RENAME TABLE) """
+        with self.connection() as myconnection:
+            myconnection.execute("DROP TABLE IF EXISTS `{}`".format(table_name))
+            myconnection.execute("ALTER TABLE `{}_new` RENAME TO `{}`".format(table_name, table_name))
+            myconnection.commit()
+
+
+def timeStage(timings, stage, function, *args, **kwargs):
+    """ Runs function, appends its wall time to timings[stage] and returns its result """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    timings.setdefault(stage, []).append(time.perf_counter() - start)
+    return result
+
+
+def summarize(samples):
+    """ Returns min, median, p95 and max seconds for a list of samples """
+    ordered = sorted(samples)
+    return {
+        "runs": len(ordered),
+        "min": ordered[0],
+        "median": statistics.median(ordered),
+        "p95": ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+        "max": ordered[-1]
+    }
+
+
+def runBenchmark(sql, scale = 1, latency = 0.0, iterations = 3, fixtures = None, max_workers = 8):
+    """ Times each pipeline stage against a stub server serving payloads at scale times the fleet size.
+    sql is the SqlUtils (or SqliteSqlUtils) the tables are written to.
+    Returns a dict with per stage timing summaries and row counts """
+    if fixtures is not None:
+        lines_json, routes_json, arrivals = fixtures
+        routes_json = scaleRoutesPayload(routes_json, scale)
+    else:
+        lines_json, routes_json, arrivals = makeLinesPayload(), makeRoutesPayload(scale), None
+    stub = StubServer(lines_json, routes_json, arrivals, latency)
+    api = stub.api(stub.start())
+    #import the deferred modules up front so the first samples of each stage do not include the import time
+    for module in (utils.pd, utils.requests, utils.orjson, utils.ijson):
+        if module is not None:
+            module.load()
+    timings = {}
+    rows = {}
+    try:
+        for iteration in range(iterations):
+            lines_json = timeStage(timings, "fetch_lines", api.getLines)
+            lines_df = timeStage(timings, "parse_lines", sql.loadLinesDf, lines_json, LINES_HEADERS, 3)
+            if sql.station_resolver is not None:
+                sql.station_resolver.addLines(lines_json)
+
+            routes_json = timeStage(timings, "fetch_routes", api.getRoutes)
+            routes_df = timeStage(timings, "parse_routes", sql.loadRoutesDf, routes_json, utils.ROUTE_HEADERS, 0)
+            if sql.tableExists("route"):
+                sql.dropTable("route")
+            sql.createTable(routes_df, "route")
+            timeStage(timings, "insert_routes", sql.insertIntoTable, routes_df, "route")
+
+            stations = timeStage(timings, "get_stations", sql.getStations, "route")
+            responses, failed_stations = timeStage(timings, "fetch_arrivals", api.getLineMetadataMany, stations,
+                                                   max_workers=max_workers)
+            if sql.station_resolver is not None:
+                sql.station_resolver.recordResults(responses)
+            line_metadata_df = timeStage(timings, "parse_arrivals", sql.parseLineMetadata, responses, LINE_METADATA_HEADERS)
+            if sql.tableExists("line_metadata"):
+                sql.dropTable("line_metadata")
+            if not line_metadata_df.empty:
+                sql.createTable(line_metadata_df, "line_metadata")
+                timeStage(timings, "insert_line_metadata", sql.insertIntoTable, line_metadata_df, "line_metadata")
+            rows = {"lines": len(lines_df), "routes": len(routes_df), "stations": len(stations),
+                    "line_metadata": len(line_metadata_df), "failed_stations": len(failed_stations)}
+    finally:
+        stub.stop()
+    return {
+        "scale": scale,
+        "latency": latency,
+        "iterations": iterations,
+        "rows": rows,
+        "stages": {stage: summarize(samples) for stage, samples in timings.items()}
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times each stage of the SEPTA pipeline against a local stub server")
+    parser.add_argument("--scale", dest="scales", type=int, nargs="+", default=[1, 10],
+                        help="Fleet size multipliers to run (e.g. 1 10 100)")
+    parser.add_argument("--latency", dest="latency", type=float, default=0.0, help="Seconds of latency per stub response")
+    parser.add_argument("--iterations", dest="iterations", type=int, default=3, help="Runs per scale")
+    parser.add_argument("--max_workers", dest="max_workers", type=int, default=8, help="Concurrent Arrivals requests")
+    parser.add_argument("--fixtures", dest="fixtures", default=None, help="Directory of recorded payloads to serve")
+    parser.add_argument("--record", dest="record", default=None, help="Record live payloads to this directory and exit")
+    parser.add_argument("--db", dest="db", choices=["sqlite", "mysql"], default="sqlite",
+                        help="Backend for the insert and getStations stages")
+    parser.add_argument("--sqlite_path", dest="sqlite_path", default=":memory:", help="SQLite database file")
+    parser.add_argument("-us", "--mysql_username", dest="user_name", default="root")
+    parser.add_argument("-pw", "--mysql_password", dest="password", default="")
+    parser.add_argument("-ho", "--mysql_host", dest="host", default="127.0.0.1")
+    parser.add_argument("-po", "--mysql_port", dest="port", default="3306")
+    parser.add_argument("-db", "--mysql_database", dest="db_name", default="septa_benchmark")
+    parser.add_argument("--station_resolver", dest="station_resolver", action="store_true",
+                        help="Resolve stations with a StationResolver so rejected names are skipped after the first run")
+    parser.add_argument("--nearest_station", dest="nearest_station", action="store_true",
+                        help="Tag vehicles with their nearest synthetic station while parsing routes")
+    parser.add_argument("--output", dest="output", default=None, help="Write the results JSON to this file")
+    args = parser.parse_args()
+
+    if args.record is not None:
+        recordFixtures(args.record)
+    else:
+        fixtures = loadFixtures(args.fixtures) if args.fixtures is not None else None
+        station_resolver = utils.StationResolver() if args.station_resolver else None
+        if args.db == "mysql":
+            sql = utils.SqlUtils(args.user_name, args.password, args.host, args.port, args.db_name,
+                                 station_resolver=station_resolver)
+        else:
+            sql = SqliteSqlUtils(args.sqlite_path, station_resolver=station_resolver)
+        if args.nearest_station:
+            sql.station_index = StationIndex.fromLocations(makeStationLocations())
+        results = {
+            "started": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "db": args.db,
+            "runs": [runBenchmark(sql, scale, args.latency, args.iterations, fixtures, args.max_workers)
+                     for scale in args.scales]
+        }
+        sql.close()
+        output = json.dumps(results, indent=2)
+        if args.output is not None:
+            with open(args.output, "w", encoding="utf-8") as output_file:
+                output_file.write(output)
+        print(output)
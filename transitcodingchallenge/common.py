@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+""" Small helpers shared by the other modules.
+
+serveHttp runs a GET only HTTP server on a background thread (the metrics, state and benchmark stub endpoints).
+atomicPath and writeJson write files through a temp file that is moved into place, so readers never see half a file.
+"""
+from contextlib import contextmanager
+import json
+import os
+import threading
+
+
+def serveHttp(respond, port, host = "127.0.0.1", name = "http-server", protocol_version = "HTTP/1.0"):
+    """ Serves GET requests on a daemon thread. respond(path) returns (body, content type) with body as str or bytes,
+    or None to answer 404. port 0 picks a free port (see server.server_port). Returns the server """
+    #imported here so runs that never serve anything do not pay for http.server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            result = respond(self.path)
+            if result is None:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body, content_type = result
+            body = body.encode("utf-8") if isinstance(body, str) else body
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            return
+
+    Handler.protocol_version = protocol_version
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name=name, daemon=True).start()
+    return server
+
+
+@contextmanager
+def atomicPath(path):
+    """ Yields a temp path next to path to write to. It replaces path when the with block finishes and is removed
+    if the block raises. The temp name is unique per thread so concurrent writers of one path do not collide """
+    temp_path = "{}.{}-{}.tmp".format(path, os.getpid(), threading.get_ident())
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def writeJson(path, data):
+    """ Writes data as JSON to path through atomicPath """
+    with atomicPath(path) as temp_path:
+        with open(temp_path, "w", encoding="utf-8") as json_file:
+            json.dump(data, json_file)
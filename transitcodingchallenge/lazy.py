@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+""" Deferred imports for the heavy dependencies.
+
+pandas, numpy, requests, mysql.connector and pyarrow take most of the start up time of the CLI. Modules bind them
+to a LazyModule instead of importing them, and the real import happens on the first attribute access, so a run
+only pays for the dependencies its steps actually use. The time spent in each deferred import is kept in
+IMPORT_SECONDS (see importReport) and recorded in METRICS as import_seconds.
+"""
+import importlib
+import importlib.util
+import time
+from transitcodingchallenge.metrics import METRICS
+
+
+#seconds spent importing each deferred module, in the order they were loaded
+IMPORT_SECONDS = {}
+
+
+class LazyModule():
+    def __init__(self, name):
+        """ Stands in for the module name until one of its attributes is used """
+        self._name = name
+        self._module = None
+
+    def load(self):
+        """ Imports the module (once) and returns it. Concurrent first uses are serialised by the import system """
+        if self._module is None:
+            start = time.perf_counter()
+            module = importlib.import_module(self._name)
+            seconds = time.perf_counter() - start
+            #a module already imported elsewhere costs next to nothing and is not worth reporting
+            if seconds >= 0.001 and self._name not in IMPORT_SECONDS:
+                IMPORT_SECONDS[self._name] = seconds
+                METRICS.observe("import_seconds", seconds, module=self._name)
+            self._module = module
+        return self._module
+
+    def __getattr__(self, attribute):
+        #only called for attributes not set in __init__, i.e. the module's own
+        return getattr(self.load(), attribute)
+
+    def __repr__(self):
+        return "<lazy module {} ({})>".format(self._name, "loaded" if self._module is not None else "not loaded")
+
+
+def available(name):
+    """ Returns True when the module name can be imported, without importing it """
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+
+def optionalModule(name):
+    """ Returns a LazyModule for an optional dependency, or None when it is not installed """
+    return LazyModule(name) if available(name) else None
+
+
+def importReport():
+    """ Returns the deferred imports loaded so far as text, slowest first """
+    if not IMPORT_SECONDS:
+        return "Deferred imports: none loaded"
+    return "Deferred imports: " + ", ".join("{} {:.0f}ms".format(name, seconds * 1000) for name, seconds in
+                                             sorted(IMPORT_SECONDS.items(), key=lambda item: item[1], reverse=True))
@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+""" Lightweight in-process metrics for the pipeline.
+
+ApiUtils, SqlUtils and the load*Df parsers record into the module level METRICS registry.
+The registry can be dumped as JSON, rendered in the Prometheus text format, or served over HTTP
+(/metrics for Prometheus, /metrics.json for JSON). Profiler wraps a run in cProfile when enabled.
+"""
+from contextlib import contextmanager
+import json
+import threading
+import time
+from transitcodingchallenge.common import atomicPath, serveHttp
+
+
+#upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+
+class Histogram():
+    def __init__(self, buckets = None):
+        """ Cumulative histogram of observed values with Prometheus style buckets """
+        self.buckets = buckets or DEFAULT_BUCKETS
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def toDict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": {str(bound): count for bound, count in zip(self.buckets, self.counts)}
+        }
+
+
+class Metrics():
+    def __init__(self):
+        """ Registry of counters, gauges and histograms. Every metric is keyed by name and a dict of labels """
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.server = None
+
+    @staticmethod
+    def key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def increment(self, name, value = 1, **labels):
+        """ Adds value to a counter """
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def setGauge(self, name, value, **labels):
+        """ Sets a gauge to value """
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        """ Records value (usually seconds) in a histogram """
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """ Records the seconds spent in the with block in the histogram name """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def toDict(self):
+        """ Returns every metric as plain python data """
+        def entries(metrics, convert):
+            return [{"name": name, "labels": dict(labels), "value": convert(value)}
+                    for (name, labels), value in sorted(metrics.items())]
+        with self.lock:
+            return {
+                "counters": entries(self.counters, lambda value: value),
+                "gauges": entries(self.gauges, lambda value: value),
+                "histograms": entries(self.histograms, lambda value: value.toDict())
+            }
+
+    def toJson(self, path = None):
+        """ Returns the metrics as a JSON string, also writing it to path if given """
+        output = json.dumps(self.toDict(), indent=2)
+        if path is not None:
+            #the daemon rewrites the file after every refresh. readers never see it half written
+            with atomicPath(path) as temp_path:
+                with open(temp_path, "w", encoding="utf-8") as json_file:
+                    json_file.write(output)
+        return output
+
+    def toPrometheus(self):
+        """ Renders the metrics in the Prometheus text exposition format """
+        def labelString(labels, extra = ()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs) + "}"
+
+        lines = []
+        with self.lock:
+            for kind, metrics in [("counter", self.counters), ("gauge", self.gauges)]:
+                for name in sorted({name for name, labels in metrics}):
+                    lines.append("# TYPE {} {}".format(name, kind))
+                    for (metric_name, labels), value in sorted(metrics.items()):
+                        if metric_name == name:
+                            lines.append("{}{} {}".format(name, labelString(labels), value))
+            for name in sorted({name for name, labels in self.histograms}):
+                lines.append("# TYPE {} histogram".format(name))
+                for (metric_name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if metric_name != name:
+                        continue
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append("{}_bucket{} {}".format(name, labelString(labels, [("le", bound)]), count))
+                    lines.append("{}_bucket{} {}".format(name, labelString(labels, [("le", "+Inf")]), histogram.count))
+                    lines.append("{}_sum{} {}".format(name, labelString(labels), histogram.sum))
+                    lines.append("{}_count{} {}".format(name, labelString(labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host = "127.0.0.1"):
+        """ Serves /metrics (Prometheus text) and /metrics.json on a background thread. Returns the server """
+        def respond(path):
+            if path == "/metrics":
+                return self.toPrometheus(), "text/plain; version=0.0.4"
+            if path == "/metrics.json":
+                return self.toJson(), "application/json"
+            return None
+
+        self.server = serveHttp(respond, port, host, name="metrics-server")
+        return self.server
+
+
+class Profiler():
+    def __init__(self, enabled = False, path = None, top = 25):
+        """ Wraps a block in cProfile when enabled. The stats are written to path (if given)
+        and the top functions by cumulative time are printed when the block exits """
+        self.enabled = enabled
+        self.path = path
+        self.top = top
+        self.profile = None
+        if enabled:
+            import cProfile
+            self.profile = cProfile.Profile()
+
+    def __enter__(self):
+        if self.enabled:
+            self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.enabled:
+            return False
+        self.profile.disable()
+        if self.path is not None:
+            self.profile.dump_stats(self.path)
+        import io
+        import pstats
+        output = io.StringIO()
+        pstats.Stats(self.profile, stream=output).sort_stats("cumulative").print_stats(self.top)
+        print(output.getvalue())
+        return False
+
+
+def endpointName(request_url):
+    """ Returns a low cardinality endpoint label for a URL, e.g. lines, TransitViewAll or Arrivals """
+    segments = [segment for segment in request_url.split("?")[0].split("/")[3:] if segment]
+    if "Arrivals" in segments:
+        return "Arrivals"
+    return segments[-1] if segments else "/"
+
+
+#registry shared by the whole process
+METRICS = Metrics()
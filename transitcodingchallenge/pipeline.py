@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+""" Dependency aware stage runner for the refresh pipeline.
+
+Each stage of a Pipeline names the stages whose results it takes as inputs. A stage starts on a worker
+thread as soon as its inputs are done, so independent stages (e.g. the Lines and Routes refreshes) run
+concurrently and the run takes as long as its critical path. iterQueued overlaps a producer and its
+consumer inside a stage through a bounded queue.
+"""
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import queue
+import threading
+import time
+from transitcodingchallenge.metrics import METRICS
+
+
+class Pipeline():
+    def __init__(self, max_workers = None):
+        """ Runs stages added with add in dependency order.
+        max_workers caps the stages running at once (defaults to one thread per stage) """
+        self.max_workers = max_workers
+        self.stages = []
+        #seconds spent in each stage during the last run
+        self.timings = {}
+
+    def add(self, name, function, inputs = ()):
+        """ Adds a stage. function is called with the results of the inputs stages, in order.
+        Inputs must already have been added, which also keeps the graph free of cycles """
+        names = [stage_name for stage_name, stage_function, stage_inputs in self.stages]
+        if name in names:
+            raise ValueError("Stage {} was already added".format(name))
+        missing = [stage_input for stage_input in inputs if stage_input not in names]
+        if missing:
+            raise ValueError("Stage {} depends on unknown stages {}".format(name, missing))
+        self.stages.append((name, function, list(inputs)))
+        return self
+
+    def runStage(self, name, function, args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.timings[name] = time.perf_counter() - start
+            METRICS.observe("stage_seconds", self.timings[name], stage=name)
+
+    def run(self):
+        """ Runs every stage and returns a dict of stage name to result.
+        When a stage raises, no new stages are started and the first error is raised once the running ones finish """
+        self.timings = {}
+        results = {}
+        pending = list(self.stages)
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=self.max_workers or max(1, len(self.stages)),
+                                thread_name_prefix="pipeline") as executor:
+            while pending or running:
+                if error is None:
+                    for stage in list(pending):
+                        name, function, inputs = stage
+                        if all(stage_input in results for stage_input in inputs):
+                            pending.remove(stage)
+                            future = executor.submit(self.runStage, name, function, [results[i] for i in inputs])
+                            running[future] = name
+                if not running:
+                    break
+                done, not_done = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        print("Stage {} failed: {}".format(name, e))
+                        if error is None:
+                            error = e
+        if error is not None:
+            raise error
+        return results
+
+
+#marks the end of the items in an iterQueued queue
+_DONE = object()
+
+
+def iterQueued(iterable, maxsize = 4):
+    """ Consumes iterable on a producer thread and yields its items through a queue of at most maxsize items,
+    so the producer (e.g. fetching and parsing) keeps working while the consumer (e.g. writing to MySQL) is busy.
+    An exception raised by the producer is raised in the consumer """
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item, error = None):
+        #give up when the consumer went away, instead of blocking on a full queue forever
+        while not stop.is_set():
+            try:
+                items.put((item, error), timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(_DONE, e)
+            return
+        put(_DONE)
+
+    producer = threading.Thread(target=produce, name="queued-producer", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is _DONE:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
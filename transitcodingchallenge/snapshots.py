@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+""" Columnar history of the route and line_metadata tables.
+
+SnapshotStore appends every dataframe the pipeline loads into MySQL to compressed Parquet files partitioned by
+table, date and hour (<path>/<table>/date=YYYY-MM-DD/hour=HH/). Repeated text columns such as route, direction
+and destination are dictionary encoded. read scans them back with the route and time filters pushed down to the
+partitions and Parquet row groups, so history queries do not touch the live MySQL tables.
+
+Needs pyarrow, which is optional: pip3 install pyarrow
+"""
+from datetime import datetime, timedelta, timezone
+import os
+import time
+import uuid
+from transitcodingchallenge.common import atomicPath
+from transitcodingchallenge.lazy import available, LazyModule
+from transitcodingchallenge.metrics import METRICS
+
+pa = LazyModule("pyarrow")
+ds = LazyModule("pyarrow.dataset")
+pq = LazyModule("pyarrow.parquet")
+
+
+#columns stored with dictionary encoding, keyed by table name
+DICTIONARY_COLUMNS = {
+    "route": ["route", "direction", "destination", "nearest_station"],
+    "line_metadata": ["line", "direction", "origin", "destination"]
+}
+
+
+def toUtc(value):
+    """ Returns value as an aware UTC datetime. Naive datetimes are taken to be UTC already """
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+class SnapshotStore():
+    def __init__(self, path, compression = "zstd", dictionary_columns = None):
+        """ path is the root directory of the snapshot files. compression is the Parquet codec.
+        dictionary_columns maps a table name to the columns that are dictionary encoded (defaults to DICTIONARY_COLUMNS) """
+        if not available("pyarrow"):
+            raise ImportError("SnapshotStore needs pyarrow. Install it with: pip3 install pyarrow")
+        self.path = path
+        self.compression = compression
+        self.dictionary_columns = DICTIONARY_COLUMNS if dictionary_columns is None else dictionary_columns
+        os.makedirs(path, exist_ok=True)
+
+    def append(self, dataframe, table_name, captured_at = None):
+        """ Writes the df as a new Parquet file in the date/hour partition of captured_at (defaults to now, UTC).
+        Every row gets a captured_at column. Returns the file written, or None for an empty df """
+        if dataframe.empty:
+            return None
+        start = time.perf_counter()
+        captured_at = toUtc(captured_at or datetime.now(timezone.utc))
+        table = pa.Table.from_pandas(dataframe, preserve_index=False)
+        table = table.append_column("captured_at", pa.array([captured_at] * len(table), pa.timestamp("us", tz="UTC")))
+        table = table.cast(self.schema(table, table_name))
+
+        partition = os.path.join(self.path, table_name, "date={:%Y-%m-%d}".format(captured_at),
+                                 "hour={:02d}".format(captured_at.hour))
+        os.makedirs(partition, exist_ok=True)
+        file_path = os.path.join(partition, "part-{:%Y%m%dT%H%M%S}-{}.parquet".format(captured_at, uuid.uuid4().hex[:8]))
+        #readers never see a half written file
+        with atomicPath(file_path) as temp_path:
+            pq.write_table(table, temp_path, compression=self.compression,
+                           use_dictionary=[column for column in self.dictionary_columns.get(table_name, [])
+                                           if column in table.column_names])
+
+        METRICS.observe("snapshot_write_seconds", time.perf_counter() - start, table=table_name)
+        METRICS.increment("snapshot_rows_total", len(table), table=table_name)
+        METRICS.increment("snapshot_bytes_total", os.path.getsize(file_path), table=table_name)
+        return file_path
+
+    def schema(self, table, table_name):
+        """ Returns the schema files are written with. Dictionary columns always use int32 indices and text columns
+        are plain strings, so files written from differently typed frames can be read back as one dataset """
+        dictionary_columns = self.dictionary_columns.get(table_name, [])
+        fields = []
+        for field in table.schema:
+            field_type = field.type
+            if field.name in dictionary_columns:
+                field_type = pa.dictionary(pa.int32(), pa.string())
+            elif pa.types.is_dictionary(field_type) or pa.types.is_null(field_type) or pa.types.is_large_string(field_type):
+                field_type = pa.string()
+            fields.append(pa.field(field.name, field_type))
+        return pa.schema(fields)
+
+    def dataset(self, table_name):
+        """ Returns the pyarrow dataset over every snapshot of table_name """
+        partitioning = ds.partitioning(pa.schema([("date", pa.string()), ("hour", pa.int32())]), flavor="hive")
+        return ds.dataset(os.path.join(self.path, table_name), format="parquet", partitioning=partitioning,
+                          exclude_invalid_files=True)
+
+    def read(self, table_name, routes = None, start = None, end = None, columns = None):
+        """ Returns the snapshots of table_name captured in [start, end) as a pandas df.
+        routes keeps only the rows whose route column (line for line_metadata) is in the list.
+        start and end are datetimes (naive ones are UTC). Partitions outside the range are never opened and the
+        route and captured_at filters are pushed down to the Parquet row groups.
+        columns limits the columns read (captured_at is always included) """
+        if not os.path.isdir(os.path.join(self.path, table_name)):
+            return None
+        dataset = self.dataset(table_name)
+        expression = None
+        def add(condition):
+            return condition if expression is None else expression & condition
+
+        if start is not None:
+            start = toUtc(start)
+            expression = add((ds.field("date") > start.strftime("%Y-%m-%d")) |
+                             ((ds.field("date") == start.strftime("%Y-%m-%d")) & (ds.field("hour") >= start.hour)))
+            expression = add(ds.field("captured_at") >= pa.scalar(start, pa.timestamp("us", tz="UTC")))
+        if end is not None:
+            end = toUtc(end)
+            expression = add((ds.field("date") < end.strftime("%Y-%m-%d")) |
+                             ((ds.field("date") == end.strftime("%Y-%m-%d")) & (ds.field("hour") <= end.hour)))
+            expression = add(ds.field("captured_at") < pa.scalar(end, pa.timestamp("us", tz="UTC")))
+        if routes is not None:
+            route_column = "route" if "route" in dataset.schema.names else "line"
+            expression = add(ds.field(route_column).isin([str(route) for route in routes]))
+        if columns is not None:
+            columns = list(dict.fromkeys(list(columns) + ["captured_at"]))
+
+        started = time.perf_counter()
+        df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+        METRICS.observe("snapshot_read_seconds", time.perf_counter() - started, table=table_name)
+        return df
+
+    def tables(self):
+        """ Returns the names of the tables that have snapshots """
+        return sorted(name for name in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, name)))
+
+
+def lastHours(hours):
+    """ Returns (start, end) covering the last hours hours, for SnapshotStore.read """
+    end = datetime.now(timezone.utc)
+    return end - timedelta(hours=hours), end
@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+""" Station locations and vectorised nearest-station lookups for TransitView vehicles.
+
+StationIndex holds the station coordinates in NumPy arrays bucketed on a uniform lat/lng grid. nearest tags a
+whole poll of vehicles with their nearest station and distance in one pass: each vehicle is compared only with
+the stations in the 3x3 block of cells around it, and the few vehicles whose answer could lie further out are
+compared with every station. within answers "which vehicles are near station X" with a bounding box prefilter.
+Distances are great circle (haversine) distances in meters.
+"""
+import csv
+import json
+import math
+from transitcodingchallenge.common import writeJson
+from transitcodingchallenge.lazy import LazyModule
+
+np = LazyModule("numpy")
+pd = LazyModule("pandas")
+
+EARTH_RADIUS_M = 6371008.8
+#meters per degree of latitude
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """ Great circle distance in meters between points given in degrees. Arguments broadcast like NumPy arrays """
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(value, dtype=float)) for value in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class StationIndex():
+    def __init__(self, names, lats, lngs, cell_degrees = None):
+        """ names, lats and lngs describe one station each. cell_degrees is the grid cell size. By default it is
+        sized so there is about one station per cell over the area the stations cover """
+        self.names = np.asarray(names, dtype=object)
+        self.lats = np.asarray(lats, dtype=float)
+        self.lngs = np.asarray(lngs, dtype=float)
+        if cell_degrees is None:
+            area = np.ptp(self.lats) * np.ptp(self.lngs) if len(self.names) > 1 else 0
+            cell_degrees = float(np.sqrt(area / len(self.names))) if area > 0 else 0.02
+        self.cell_degrees = cell_degrees
+        self.positions = {name: i for i, name in enumerate(self.names)}
+        self.buildGrid()
+
+    def buildGrid(self):
+        """ Lists, for every cell that has a station in its 3x3 block, the stations of that block.
+        The lists are padded with -1 into one array so a poll can be looked up without a python loop """
+        rows, columns = self.cells(self.lats, self.lngs)
+        blocks = {}
+        for station, (row, column) in enumerate(zip(rows.tolist(), columns.tolist())):
+            for d_row in (-1, 0, 1):
+                for d_column in (-1, 0, 1):
+                    blocks.setdefault(self.cellKey(row + d_row, column + d_column), []).append(station)
+        self.cell_keys = np.array(sorted(blocks), dtype=np.int64)
+        width = max((len(stations) for stations in blocks.values()), default=0)
+        self.cell_stations = np.full((len(self.cell_keys), max(width, 1)), -1, dtype=np.int64)
+        for i, key in enumerate(self.cell_keys.tolist()):
+            self.cell_stations[i, :len(blocks[key])] = blocks[key]
+
+    def cells(self, lats, lngs):
+        """ Returns the grid row and column of each point """
+        return (np.floor(np.asarray(lats, dtype=float) / self.cell_degrees).astype(np.int64),
+                np.floor(np.asarray(lngs, dtype=float) / self.cell_degrees).astype(np.int64))
+
+    @staticmethod
+    def cellKey(row, column):
+        #rows and columns stay well inside +-2**20 for any lat/lng unless cells are far smaller than a meter
+        return (row + 2**20) * 2**21 + (column + 2**20)
+
+    @classmethod
+    def fromLocations(cls, locations_json, **kwargs):
+        """ Builds the index from a SEPTA locations API response (location_name, location_lat, location_lon)
+        or a list of {"name", "lat", "lng"} dicts """
+        names, lats, lngs = [], [], []
+        for location in locations_json:
+            lat = location.get("location_lat", location.get("lat"))
+            lng = location.get("location_lon", location.get("lng"))
+            if lat is None or lng is None:
+                continue
+            names.append(location.get("location_name", location.get("name")))
+            lats.append(float(lat))
+            lngs.append(float(lng))
+        return cls(names, lats, lngs, **kwargs)
+
+    @classmethod
+    def fromFile(cls, path, **kwargs):
+        """ Builds the index from a JSON file (as written by save, or a saved locations API response)
+        or a CSV file with name, lat and lng columns """
+        with open(path, encoding="utf-8", newline="") as locations_file:
+            if path.lower().endswith(".csv"):
+                return cls.fromLocations(list(csv.DictReader(locations_file)), **kwargs)
+            return cls.fromLocations(json.load(locations_file), **kwargs)
+
+    def save(self, path):
+        """ Writes the stations to a JSON file fromFile can read """
+        locations = [{"name": name, "lat": lat, "lng": lng}
+                     for name, lat, lng in zip(self.names.tolist(), self.lats.tolist(), self.lngs.tolist())]
+        writeJson(path, locations)
+
+    def nearest(self, lats, lngs):
+        """ Returns (station names, distances in meters) of the nearest station to each point.
+        Points without coordinates get None and NaN """
+        lats = np.asarray(lats, dtype=float)
+        lngs = np.asarray(lngs, dtype=float)
+        nearest = np.full(len(lats), -1, dtype=np.int64)
+        distances = np.full(len(lats), np.nan)
+        valid = ~(np.isnan(lats) | np.isnan(lngs))
+        if len(self.names) and valid.any():
+            points = np.nonzero(valid)[0]
+            rows, columns = self.cells(lats[points], lngs[points])
+            keys = self.cellKey(rows, columns)
+            slots = np.clip(np.searchsorted(self.cell_keys, keys), 0, len(self.cell_keys) - 1)
+            candidates = np.where((self.cell_keys[slots] == keys)[:, None], self.cell_stations[slots], -1)
+            candidate_distances = haversine(lats[points, None], lngs[points, None],
+                                            self.lats[candidates], self.lngs[candidates])
+            candidate_distances[candidates < 0] = np.inf
+            best = np.argmin(candidate_distances, axis=1)
+            nearest[points] = candidates[np.arange(len(points)), best]
+            distances[points] = candidate_distances[np.arange(len(points)), best]
+
+            #the 3x3 block only guarantees the answer within one cell width of the point. check the rest against all stations
+            cell_width = self.cell_degrees * METERS_PER_DEGREE * np.cos(np.radians(np.abs(lats[points]) + self.cell_degrees))
+            unsure = points[~(distances[points] <= cell_width)]
+            if len(unsure):
+                all_distances = haversine(lats[unsure, None], lngs[unsure, None], self.lats[None, :], self.lngs[None, :])
+                best = np.argmin(all_distances, axis=1)
+                nearest[unsure] = best
+                distances[unsure] = all_distances[np.arange(len(unsure)), best]
+        names = np.full(len(lats), None, dtype=object)
+        found = nearest >= 0
+        names[found] = self.names[nearest[found]]
+        return names, distances
+
+    def within(self, station, lats, lngs, radius):
+        """ Returns the positions of the points within radius meters of station """
+        i = self.positions[station]
+        lats = np.asarray(lats, dtype=float)
+        lngs = np.asarray(lngs, dtype=float)
+        #cheap bounding box first, haversine only for the points inside it
+        d_lat = radius / METERS_PER_DEGREE
+        d_lng = d_lat / max(np.cos(np.radians(abs(self.lats[i]) + d_lat)), 1e-6)
+        box = np.nonzero((np.abs(lats - self.lats[i]) <= d_lat) & (np.abs(lngs - self.lngs[i]) <= d_lng))[0]
+        return box[haversine(lats[box], lngs[box], self.lats[i], self.lngs[i]) <= radius]
+
+    def stationsWithin(self, lat, lng, radius):
+        """ Returns the names of the stations within radius meters of a point, nearest first """
+        distances = haversine(lat, lng, self.lats, self.lngs)
+        order = np.argsort(distances)
+        return [self.names[i] for i in order if distances[i] <= radius]
+
+
+def addNearestStation(dataframe, station_index):
+    """ Adds nearest_station and station_distance_m columns to a routes df with lat and lng columns, in one pass """
+    if "lat" not in dataframe.columns or "lng" not in dataframe.columns:
+        return dataframe
+    names, distances = station_index.nearest(dataframe["lat"].to_numpy(dtype=float, na_value=np.nan),
+                                             dataframe["lng"].to_numpy(dtype=float, na_value=np.nan))
+    dataframe["nearest_station"] = pd.Categorical(names)
+    dataframe["station_distance_m"] = distances.round(1)
+    return dataframe
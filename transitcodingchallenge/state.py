@@ -0,0 +1,264 @@
+#!/usr/bin/python3
+""" In-process index of the latest vehicle and train positions.
+
+StateIndex keeps one compact record per vehicle (from the route loads) and per train (from the line_metadata
+loads), keyed by vehicle_id and train_id, with secondary indexes on route, destination and station. SqlUtils
+updates it on every load, so "where is vehicle X" or "which trains are heading to Y" are answered from memory
+instead of MySQL, from Python or over a small local HTTP endpoint (serve).
+"""
+import json
+import threading
+import time
+from urllib.parse import unquote
+from transitcodingchallenge.common import serveHttp
+from transitcodingchallenge.metrics import METRICS
+
+
+class VehicleState():
+    __slots__ = ("vehicle_id", "route", "direction", "destination", "lat", "lng", "nearest_station", "updated_at")
+
+    def __init__(self, vehicle_id, route, direction, destination, updated_at):
+        self.vehicle_id = vehicle_id
+        self.route = route
+        self.direction = direction
+        self.destination = destination
+        #position and nearest station, when the routes df has them (see spatial.addNearestStation)
+        self.lat = None
+        self.lng = None
+        self.nearest_station = None
+        self.updated_at = updated_at
+
+    def toDict(self):
+        return dict({name: getattr(self, name) for name in self.__slots__}, updated_at=timestampText(self.updated_at))
+
+
+class TrainState():
+    __slots__ = ("train_id", "direction", "origin", "destination", "stations", "updated_at")
+
+    def __init__(self, train_id, direction, origin, destination, stations, updated_at):
+        self.train_id = train_id
+        self.direction = direction
+        self.origin = origin
+        self.destination = destination
+        #stations whose arrivals board lists the train
+        self.stations = stations
+        self.updated_at = updated_at
+
+    def toDict(self):
+        return dict({name: getattr(self, name) for name in self.__slots__}, stations=sorted(self.stations),
+                    updated_at=timestampText(self.updated_at))
+
+
+def textOrNone(value):
+    """ Returns value as a str, or None for missing values (None, NaN, pd.NA) """
+    if value is None:
+        return None
+    try:
+        if value != value:
+            return None
+    except TypeError:
+        #pd.NA cannot be used as a bool
+        return None
+    return str(value)
+
+
+def timestampText(value):
+    """ Returns a datetime as ISO 8601 text so records can be sent as JSON. Other values are returned as they are """
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+
+def floatOrNone(value):
+    """ Returns value as a float, or None for missing values """
+    text = textOrNone(value)
+    return float(text) if text is not None else None
+
+
+def addToIndex(index, key, record_id):
+    if key is not None:
+        index.setdefault(key, set()).add(record_id)
+
+
+def removeFromIndex(index, key, record_id):
+    ids = index.get(key)
+    if ids is not None:
+        ids.discard(record_id)
+        if not ids:
+            del index[key]
+
+
+class StateIndex():
+    def __init__(self):
+        """ Latest state of every vehicle and train seen in the most recent loads """
+        self.lock = threading.Lock()
+        self.vehicles = {}
+        self.vehicles_by_route = {}
+        self.vehicles_by_destination = {}
+        self.vehicles_by_station = {}
+        self.trains = {}
+        self.trains_by_station = {}
+        self.trains_by_destination = {}
+        self.server = None
+
+    def update(self, dataframe, table_name, updated_at = None):
+        """ Applies a route or line_metadata df. Records are replaced in place and the secondary indexes are only
+        touched for the keys that changed. Other tables are ignored. Call prune with the same updated_at once the
+        load is complete to drop the vehicles and trains that were not in it """
+        updated_at = updated_at if updated_at is not None else time.time()
+        start = time.perf_counter()
+        if table_name == "route":
+            self.updateVehicles(dataframe, updated_at)
+        elif table_name == "line_metadata":
+            self.updateTrains(dataframe, updated_at)
+        else:
+            return
+        METRICS.observe("state_update_seconds", time.perf_counter() - start, table=table_name)
+
+    def updateVehicles(self, dataframe, updated_at):
+        columns = [dataframe[column].tolist() if column in dataframe.columns else [None] * len(dataframe)
+                   for column in ["vehicle_id", "route", "direction", "destination", "lat", "lng", "nearest_station"]]
+        with self.lock:
+            for vehicle_id, route, direction, destination, lat, lng, station in zip(*columns):
+                vehicle_id = textOrNone(vehicle_id)
+                if vehicle_id is None:
+                    continue
+                route, direction, destination = textOrNone(route), textOrNone(direction), textOrNone(destination)
+                station = textOrNone(station)
+                vehicle = self.vehicles.get(vehicle_id)
+                if vehicle is None:
+                    vehicle = VehicleState(vehicle_id, route, direction, destination, updated_at)
+                    self.vehicles[vehicle_id] = vehicle
+                    addToIndex(self.vehicles_by_route, route, vehicle_id)
+                    addToIndex(self.vehicles_by_destination, destination, vehicle_id)
+                if vehicle.route != route:
+                    removeFromIndex(self.vehicles_by_route, vehicle.route, vehicle_id)
+                    addToIndex(self.vehicles_by_route, route, vehicle_id)
+                    vehicle.route = route
+                if vehicle.destination != destination:
+                    removeFromIndex(self.vehicles_by_destination, vehicle.destination, vehicle_id)
+                    addToIndex(self.vehicles_by_destination, destination, vehicle_id)
+                    vehicle.destination = destination
+                if vehicle.nearest_station != station:
+                    removeFromIndex(self.vehicles_by_station, vehicle.nearest_station, vehicle_id)
+                    addToIndex(self.vehicles_by_station, station, vehicle_id)
+                    vehicle.nearest_station = station
+                vehicle.direction = direction
+                vehicle.lat = floatOrNone(lat)
+                vehicle.lng = floatOrNone(lng)
+                vehicle.updated_at = updated_at
+
+    def updateTrains(self, dataframe, updated_at):
+        #the line column of line_metadata holds the station whose arrivals board listed the train
+        columns = [dataframe[column].tolist() for column in ["train_id", "line", "direction", "origin", "destination"]]
+        with self.lock:
+            for train_id, station, direction, origin, destination in zip(*columns):
+                train_id = textOrNone(train_id)
+                if train_id is None:
+                    continue
+                station, destination = textOrNone(station), textOrNone(destination)
+                train = self.trains.get(train_id)
+                if train is None or train.updated_at != updated_at:
+                    #first row of this train in the load. its station list starts over
+                    if train is None:
+                        train = TrainState(train_id, None, None, None, set(), updated_at)
+                        self.trains[train_id] = train
+                    for old_station in train.stations:
+                        removeFromIndex(self.trains_by_station, old_station, train_id)
+                    train.stations = set()
+                    train.updated_at = updated_at
+                if station is not None and station not in train.stations:
+                    train.stations.add(station)
+                    addToIndex(self.trains_by_station, station, train_id)
+                if train.destination != destination:
+                    removeFromIndex(self.trains_by_destination, train.destination, train_id)
+                    addToIndex(self.trains_by_destination, destination, train_id)
+                    train.destination = destination
+                train.direction = textOrNone(direction)
+                train.origin = textOrNone(origin)
+
+    def prune(self, table_name, updated_at):
+        """ Drops the vehicles (route) or trains (line_metadata) that were not in the load stamped updated_at """
+        with self.lock:
+            if table_name == "route":
+                for vehicle_id in [vehicle_id for vehicle_id, vehicle in self.vehicles.items() if vehicle.updated_at != updated_at]:
+                    vehicle = self.vehicles.pop(vehicle_id)
+                    removeFromIndex(self.vehicles_by_route, vehicle.route, vehicle_id)
+                    removeFromIndex(self.vehicles_by_destination, vehicle.destination, vehicle_id)
+                    removeFromIndex(self.vehicles_by_station, vehicle.nearest_station, vehicle_id)
+            elif table_name == "line_metadata":
+                for train_id in [train_id for train_id, train in self.trains.items() if train.updated_at != updated_at]:
+                    train = self.trains.pop(train_id)
+                    for station in train.stations:
+                        removeFromIndex(self.trains_by_station, station, train_id)
+                    removeFromIndex(self.trains_by_destination, train.destination, train_id)
+            METRICS.setGauge("state_vehicles", len(self.vehicles))
+            METRICS.setGauge("state_trains", len(self.trains))
+
+    def vehicle(self, vehicle_id):
+        """ Returns the VehicleState of vehicle_id, or None """
+        return self.vehicles.get(str(vehicle_id))
+
+    def vehiclesOnRoute(self, route):
+        """ Returns the VehicleStates on route """
+        with self.lock:
+            return [self.vehicles[vehicle_id] for vehicle_id in self.vehicles_by_route.get(str(route), ())]
+
+    def vehiclesTo(self, destination):
+        """ Returns the VehicleStates heading to destination """
+        with self.lock:
+            return [self.vehicles[vehicle_id] for vehicle_id in self.vehicles_by_destination.get(destination, ())]
+
+    def vehiclesNear(self, station):
+        """ Returns the VehicleStates whose nearest station is station """
+        with self.lock:
+            return [self.vehicles[vehicle_id] for vehicle_id in self.vehicles_by_station.get(station, ())]
+
+    def train(self, train_id):
+        """ Returns the TrainState of train_id, or None """
+        return self.trains.get(str(train_id))
+
+    def trainsAt(self, station):
+        """ Returns the TrainStates listed on the arrivals board of station """
+        with self.lock:
+            return [self.trains[train_id] for train_id in self.trains_by_station.get(station, ())]
+
+    def trainsTo(self, destination):
+        """ Returns the TrainStates heading to destination """
+        with self.lock:
+            return [self.trains[train_id] for train_id in self.trains_by_destination.get(destination, ())]
+
+    def stats(self):
+        """ Returns the number of vehicles, trains, routes and stations indexed """
+        return {"vehicles": len(self.vehicles), "trains": len(self.trains),
+                "routes": len(self.vehicles_by_route), "stations": len(self.trains_by_station)}
+
+    def query(self, path):
+        """ Answers an HTTP path with a JSON serialisable result, or None when the path is unknown.
+        /vehicles/<id>, /routes/<route>/vehicles, /destinations/<name>/vehicles, /stations/<name>/vehicles, /trains/<id>,
+        /stations/<name>/trains, /destinations/<name>/trains and /stats """
+        parts = [unquote(part) for part in path.split("?")[0].strip("/").split("/")]
+        if parts == ["stats"]:
+            return self.stats()
+        if len(parts) == 2 and parts[0] in ("vehicles", "trains"):
+            record = self.vehicle(parts[1]) if parts[0] == "vehicles" else self.train(parts[1])
+            return record.toDict() if record is not None else None
+        if len(parts) == 3:
+            lookups = {
+                ("routes", "vehicles"): self.vehiclesOnRoute,
+                ("destinations", "vehicles"): self.vehiclesTo,
+                ("stations", "vehicles"): self.vehiclesNear,
+                ("stations", "trains"): self.trainsAt,
+                ("destinations", "trains"): self.trainsTo
+            }
+            lookup = lookups.get((parts[0], parts[2]))
+            if lookup is not None:
+                return [record.toDict() for record in lookup(parts[1])]
+        return None
+
+    def serve(self, port, host = "127.0.0.1"):
+        """ Serves query over HTTP as JSON on a background thread. Returns the server """
+        def respond(path):
+            result = self.query(path)
+            return (json.dumps(result), "application/json") if result is not None else None
+
+        self.server = serveHttp(respond, port, host, name="state-server")
+        return self.server
@@ -1,128 +1,967 @@
 #!/usr/bin/python3
+from collections import deque, OrderedDict
+from concurrent.futures import as_completed, ThreadPoolExecutor
+from contextlib import contextmanager
+import csv
+from datetime import datetime, timezone
+import hashlib
 import json
-from mysql.connector import connect, Error
-import pandas as pd
-from pprint import pprint
-import requests
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from transitcodingchallenge.common import writeJson
+from transitcodingchallenge.lazy import LazyModule, optionalModule
+from transitcodingchallenge.metrics import endpointName, METRICS
+from transitcodingchallenge.spatial import addNearestStation
+from urllib.parse import urlparse
+
+#imported on first use so steps that never touch them start faster (see lazy.py)
+mysql_connector = LazyModule("mysql.connector")
+pd = LazyModule("pandas")
+requests = LazyModule("requests")
+
+#optional faster JSON decoders
+ijson = optionalModule("ijson")
+orjson = optionalModule("orjson")
+
+
+LINES_URL = "https://www.septastats.com/api/current/lines"
+ROUTES_URL = "http://www3.septa.org/hackathon/TransitViewAll/"
+ARRIVALS_URL = "http://www3.septa.org/hackathon/Arrivals/"
+LOCATIONS_URL = "http://www3.septa.org/hackathon/locations/get_locations.php"
+
+#seconds a cached response stays fresh, by URL prefix. lines rarely change, vehicle positions change constantly
+ENDPOINT_TTLS = {
+    LINES_URL: 3600,
+    ROUTES_URL: 5,
+    ARRIVALS_URL: 15,
+    LOCATIONS_URL: 86400
+}
+
+
+class RateLimiter():
+    def __init__(self, requests_per_second):
+        """ Spaces out requests so that no single host receives more than
+        requests_per_second calls. A value of None disables the limit """
+        self.requests_per_second = requests_per_second
+        self.lock = threading.Lock()
+        self.next_slot = {}
+
+    def wait(self, url):
+        """ Blocks the calling thread until the host of url has a free slot """
+        if not self.requests_per_second:
+            return
+        host = urlparse(url).netloc
+        interval = 1.0 / self.requests_per_second
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class HttpClient():
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, connect_timeout = 3.05, read_timeout = 20, max_retries = 3, backoff_factor = 0.5,
+                 pool_maxsize = 16, requests_per_second = 10):
+        """ Keep-alive HTTP client shared by the API calls.
+        Connections are pooled per host (up to pool_maxsize each) so repeated polling reuses
+        the TCP connection and TLS session instead of reconnecting on every call.
+        connect_timeout and read_timeout are in seconds.
+        5xx responses and connection errors are retried max_retries times with jittered exponential backoff.
+        requests_per_second caps the calls made to any one host. None disables the limit """
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate"})
+        #latency and size of the most recent calls, newest last
+        self.calls = deque(maxlen=1000)
+        #retries made by get (after 5xx responses and connection errors) since the client was created
+        self.retries = 0
+        self.retries_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """ Returns the process wide client, creating it on first use """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def get(self, request_url, headers = None, stream = False):
+        """ Sends a GET request through the pooled session, retrying 5xx responses and connection errors.
+        stream leaves the body unread so it can be consumed incrementally from response.raw.
+        Returns the final response. Raises the last requests exception if every attempt failed """
+        attempt = 0
+        while True:
+            self.rate_limiter.wait(request_url)
+            start = time.monotonic()
+            try:
+                response = self.session.get(request_url, headers=headers, timeout=self.timeout, stream=stream)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                print("Retrying {} after error: {}".format(request_url, e))
+            else:
+                self.recordCall(request_url, response, time.monotonic() - start, attempt, stream)
+                if response.status_code < 500 or attempt >= self.max_retries:
+                    return response
+                print("Retrying {} after status {}".format(request_url, response.status_code))
+                #hand the connection back to the pool now. a streamed body is never read and would hold it until gc
+                response.close()
+            #full jitter: sleep a random amount up to the exponential backoff
+            time.sleep(random.uniform(0, self.backoff_factor * (2 ** attempt)))
+            attempt += 1
+            with self.retries_lock:
+                self.retries += 1
+            METRICS.increment("api_retries_total", endpoint=endpointName(request_url))
+
+    def recordCall(self, request_url, response, seconds, attempt, stream = False):
+        """ Keeps the latency, decoded size and on the wire size of a call, and records them in METRICS per endpoint.
+        For streamed calls the body has not been read yet, so seconds is the time to the headers and
+        the size is taken from Content-Length """
+        wire_bytes = response.headers.get("Content-Length")
+        if stream:
+            body_bytes = int(wire_bytes) if wire_bytes is not None else 0
+        else:
+            body_bytes = len(response.content)
+        endpoint = endpointName(request_url)
+        METRICS.observe("api_request_seconds", seconds, endpoint=endpoint)
+        METRICS.increment("api_requests_total", endpoint=endpoint, status=response.status_code)
+        METRICS.increment("api_response_bytes_total", body_bytes, endpoint=endpoint)
+        self.calls.append({
+            "url": request_url,
+            "status": response.status_code,
+            "seconds": seconds,
+            "bytes": body_bytes,
+            "wire_bytes": int(wire_bytes) if wire_bytes is not None else None,
+            #0 for the first try of a request, 1 for its first retry...
+            "attempt": attempt
+        })
+
+    def summary(self):
+        """ Returns call count, total seconds and total bytes for the recorded calls,
+        and the number of retries get made (connection error retries included) """
+        calls = list(self.calls)
+        return {
+            "calls": len(calls),
+            "seconds": sum(call["seconds"] for call in calls),
+            "bytes": sum(call["bytes"] for call in calls),
+            "retries": self.retries
+        }
+
+
+class RetryPolicy():
+    def __init__(self, attempts = 3, backoff_factor = 1.0, max_backoff = 10, retry_failed = True):
+        """ How loadLineMetaDf retries arrivals. attempts is the total number of rounds (the first call included).
+        Rounds are spaced with jittered exponential backoff of up to backoff_factor * 2 ** (round - 1) seconds,
+        capped at max_backoff. retry_failed also retries the stations whose request failed when others succeeded """
+        self.attempts = attempts
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.retry_failed = retry_failed
+
+    def delay(self, attempt):
+        """ Returns the seconds to wait after round attempt (1 based) """
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** (attempt - 1)))
+
+
+class ResponseCache():
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, ttls = None, max_entries = 256, path = None):
+        """ Caches API response bodies by URL.
+        ttls maps a URL prefix to the seconds a response stays fresh (defaults to ENDPOINT_TTLS). URLs without a
+        matching prefix are not cached. The least recently used entry is evicted once max_entries are stored.
+        path is an optional directory where entries are also written so the cache survives restarts.
+        Stale entries that carried an ETag or Last-Modified header are revalidated with a conditional request """
+        self.ttls = ENDPOINT_TTLS if ttls is None else ttls
+        self.max_entries = max_entries
+        self.path = path
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    @classmethod
+    def shared(cls):
+        """ Returns the process wide in-memory cache, creating it on first use """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def ttl(self, request_url):
+        """ Returns the TTL of the longest URL prefix matching request_url, or None if the URL is not cached """
+        prefixes = [prefix for prefix in self.ttls if request_url.startswith(prefix)]
+        if not prefixes:
+            return None
+        return self.ttls[max(prefixes, key=len)]
+
+    def lookup(self, request_url):
+        """ Returns (entry, fresh) for request_url. entry is None on a miss.
+        A stale entry is still returned so its validators can be used for revalidation """
+        ttl = self.ttl(request_url)
+        if ttl is None:
+            return None, False
+        with self.lock:
+            entry = self.entries.get(request_url)
+            if entry is None:
+                entry = self.readEntry(request_url)
+                if entry is not None:
+                    self.entries[request_url] = entry
+            if entry is not None:
+                self.entries.move_to_end(request_url)
+            fresh = entry is not None and time.time() - entry["stored"] < ttl
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        METRICS.increment("api_cache_hits_total" if fresh else "api_cache_misses_total", endpoint=endpointName(request_url))
+        return entry, fresh
+
+    def revalidationHeaders(self, entry):
+        """ Returns the If-None-Match / If-Modified-Since headers for a stale entry """
+        headers = {}
+        if entry is not None and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry is not None and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def store(self, request_url, body, headers):
+        """ Stores a 200 response body with its validators """
+        if self.ttl(request_url) is None:
+            return
+        entry = {
+            "url": request_url,
+            "stored": time.time(),
+            "body": body.decode("utf-8") if isinstance(body, bytes) else body,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified")
+        }
+        self.putEntry(entry)
+
+    def refresh(self, entry):
+        """ Marks an entry fresh again after upstream answered 304 Not Modified """
+        self.revalidations += 1
+        self.putEntry(dict(entry, stored=time.time()))
+
+    def putEntry(self, entry):
+        """ Adds or replaces an entry, evicting the least recently used entries over max_entries """
+        with self.lock:
+            self.entries[entry["url"]] = entry
+            self.entries.move_to_end(entry["url"])
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        self.writeEntry(entry)
+
+    def entryPath(self, request_url):
+        """ Returns the on-disk file for request_url """
+        return os.path.join(self.path, hashlib.sha1(request_url.encode("utf-8")).hexdigest() + ".json")
+
+    def readEntry(self, request_url):
+        """ Loads an entry from the on-disk store, if there is one """
+        if self.path is None or not os.path.exists(self.entryPath(request_url)):
+            return None
+        try:
+            with open(self.entryPath(request_url), encoding="utf-8") as entry_file:
+                return json.load(entry_file)
+        except (OSError, ValueError) as e:
+            print("Ignoring unreadable cache entry for {}: {}".format(request_url, e))
+            return None
+
+    def writeEntry(self, entry):
+        """ Writes an entry to the on-disk store through a temp file so readers never see half an entry """
+        if self.path is None:
+            return
+        writeJson(self.entryPath(entry["url"]), entry)
+
+    def stats(self):
+        """ Returns the hit, miss and revalidation counters and the number of stored entries """
+        return {"hits": self.hits, "misses": self.misses, "revalidations": self.revalidations,
+                "entries": len(self.entries)}
 
 
 class ApiUtils():
+    def __init__(self, client = None, cache = None, lines_url = LINES_URL, routes_url = ROUTES_URL, arrivals_url = ARRIVALS_URL,
+                 locations_url = LOCATIONS_URL):
+        """ client is the HttpClient used for every call. Defaults to the shared pooled client
+        cache is the ResponseCache consulted before every call. Defaults to the shared in-memory cache.
+        Pass cache=False to always call upstream
+        lines_url, routes_url, arrivals_url and locations_url point the calls at another server (e.g. the benchmark stub) """
+        self.client = client if client is not None else HttpClient.shared()
+        self.lines_url = lines_url
+        self.routes_url = routes_url
+        self.arrivals_url = arrivals_url
+        self.locations_url = locations_url
+        if cache is None:
+            cache = ResponseCache.shared()
+        self.cache = cache or None
 
-    def getApiResponse(self, request_url):
+    def getApiResponse(self, request_url, use_cache = True):
         """Sends the GET request to and API that does not require headers.
         request_url is url for API endpoint
-        Returns API response formatted as JSON """
-        response = requests.get(request_url)
+        Fresh cached responses are returned without calling upstream. use_cache=False always calls upstream
+        (the response is still stored for later calls).
+        Returns API response formatted as JSON. Returns None for any status other than 200 """
+        entry, headers = None, None
+        if self.cache is not None and use_cache:
+            entry, fresh = self.cache.lookup(request_url)
+            if fresh:
+                return loadJson(entry["body"])
+            headers = self.cache.revalidationHeaders(entry)
+        response = self.client.get(request_url, headers)
+        if response.status_code == 304 and entry is not None:
+            #upstream confirmed the cached body is still current
+            self.cache.refresh(entry)
+            return loadJson(entry["body"])
         if response.status_code == 200:
-            response_json = json.loads(response.content)
+            if self.cache is not None:
+                self.cache.store(request_url, response.content, response.headers)
+            response_json = loadJson(response.content)
             return response_json
+        print("{} returned status {}".format(request_url, response.status_code))
 
     def getLines(self):
         """ Step 1 - Task 1: Call the lines API endpoint
         and Load the API response into a variable """
-        request_url = "https://www.septastats.com/api/current/lines"
+        request_url = self.lines_url
         api_response = self.getApiResponse(request_url)
         return api_response
 
     def getRoutes(self):
         """ Step 2 - Task 1: Call the routes API endpoint
         and Load the API response into a variable """
-        request_url = "http://www3.septa.org/hackathon/TransitViewAll/"
+        request_url = self.routes_url
         api_response = self.getApiResponse(request_url)
         return api_response
 
-    def getLineMetadata(self, station, n = None):
+    def getCachedResponse(self, request_url):
+        """ Returns the cached response for request_url as JSON however old it is, without calling upstream.
+        Returns None when nothing is cached (always the case with cache=False) """
+        if self.cache is None:
+            return None
+        entry, fresh = self.cache.lookup(request_url)
+        return loadJson(entry["body"]) if entry is not None else None
+
+    def getStationLocations(self, lat = 39.9526, lng = -75.1652, radius = 60, location_type = "rail_stations"):
+        """ Calls the locations API endpoint for the stations of location_type within radius miles of lat, lng
+        (defaults cover every Regional Rail station from Center City). Returns a list of location dicts with
+        location_name, location_lat and location_lon """
+        request_url = self.locations_url + "?lon={}&lat={}&type={}&radius={}".format(lng, lat, location_type, radius)
+        api_response = self.getApiResponse(request_url)
+        return api_response
+
+    def iterRouteSegments(self):
+        """ Streams the routes API endpoint and yields (route_id, route_segment) tuples as they are decoded.
+        With ijson installed the body is parsed incrementally from the socket one route at a time, so memory stays
+        flat as the payload grows. Otherwise the whole body is decoded at once with orjson (if installed) or json.
+        A fresh cached response is used without calling upstream. Without ijson the body is stored in the response
+        cache like getRoutes does. With ijson it is never held whole, so it is not cached and getRoutes,
+        getCachedResponse (e.g. main.py arrivals --stations_from cache) and the loadLineMetaDf fallback fetch it again """
+        if self.cache is not None:
+            entry, fresh = self.cache.lookup(self.routes_url)
+            if fresh:
+                yield from routeSegments(loadJson(entry["body"]))
+                return
+        response = self.client.get(self.routes_url, stream=True)
+        try:
+            if response.status_code != 200:
+                print("{} returned status {}".format(self.routes_url, response.status_code))
+                return
+            if ijson is not None:
+                #let urllib3 undo the gzip encoding while ijson reads
+                response.raw.decode_content = True
+                for route_id, route_segments in ijson.kvitems(response.raw, "routes.item", use_float=True):
+                    for route_segment in route_segments:
+                        yield route_id, route_segment
+            else:
+                if self.cache is not None:
+                    self.cache.store(self.routes_url, response.content, response.headers)
+                yield from routeSegments(loadJson(response.content))
+        finally:
+            response.close()
+
+    def getLineMetadata(self, station, n = None, use_cache = True):
         """ Step 3 - Task 1: Call the current lines metadata (arrivals) API endpoint
         and Load the response into a variable
         station is the Regional Station name where the trains are arriving
-        n is an integer that allows us to get the next n sequential trains that arrive at the station"""
+        n is an integer that allows us to get the next n sequential trains that arrive at the station
+        use_cache=False skips the response cache, e.g. when retrying an empty answer"""
         if n is None:
             #get all arrivals
-            request_url = "http://www3.septa.org/hackathon/Arrivals/{}/".format(station,n)
-            api_response = self.getApiResponse(request_url)
+            request_url = self.arrivals_url + "{}/".format(station)
+            api_response = self.getApiResponse(request_url, use_cache)
         else:
             #get n number of arrivals
-            request_url = "http://www3.septa.org/hackathon/Arrivals/{}/{}/".format(station,n)
-            api_response = self.getApiResponse(request_url)
+            request_url = self.arrivals_url + "{}/{}/".format(station,n)
+            api_response = self.getApiResponse(request_url, use_cache)
         return api_response
 
+    def getLineMetadataMany(self, stations, n = None, max_workers = 8, use_cache = True):
+        """ Calls the arrivals API endpoint for every station using a bounded thread pool.
+        At most max_workers requests are in flight at once and the per host rate limit still applies.
+        Returns a list of (station, api_response) tuples in the same order as stations and a list
+        of the stations whose request raised an error or did not return a 200 response"""
+        def fetch(station):
+            return self.fetchLineMetadata(station, n, use_cache)
+
+        stations = list(stations)
+        if max_workers is None or max_workers <= 1 or len(stations) <= 1:
+            responses = [fetch(station) for station in stations]
+        else:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(stations))) as executor:
+                #executor.map yields results in the order the stations were submitted
+                responses = list(executor.map(fetch, stations))
+
+        results = list(zip(stations, responses))
+        failed_stations = [station for station, response in results if response is None]
+        return results, failed_stations
+
+    def iterLineMetadata(self, stations, n = None, max_workers = 8, use_cache = True):
+        """ Like getLineMetadataMany but yields (station, api_response) tuples as soon as each request completes,
+        so the responses can be parsed and written while later stations are still being fetched.
+        Tuples come in completion order. api_response is None for stations whose request failed """
+        stations = list(stations)
+        if not stations:
+            return
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers or 1, len(stations)))) as executor:
+            futures = {executor.submit(self.fetchLineMetadata, station, n, use_cache): station for station in stations}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    def fetchLineMetadata(self, station, n = None, use_cache = True):
+        """ Calls getLineMetadata, returning None instead of raising when the request fails
+        or the response is not JSON (e.g. an HTML error page) """
+        try:
+            return self.getLineMetadata(station, n, use_cache)
+        except requests.exceptions.RequestException as e:
+            print("Arrivals request failed for {}: {}".format(station, e))
+            return None
+        except ValueError as e:
+            print("Arrivals response for {} is not JSON: {}".format(station, e))
+            return None
+
+#column headers of the routes dataframe. the coordinates are kept as floats
+POSITION_HEADERS = ["lat", "lng"]
+ROUTE_HEADERS = ["route", "vehicle_id", "direction", "destination"] + POSITION_HEADERS
+#column dtypes by position for the routes and line metadata dataframes. None keeps the default
+ROUTE_DTYPES = ["category", "Int64", "category", "string", "float64", "float64"]
+LINE_METADATA_DTYPES = [None, "category", "string", "string", None]
+
+#columns that identify a row when a table is synced incrementally with upsertTable
+TABLE_KEYS = {
+    "route": ["route", "vehicle_id"],
+    "line_metadata": ["line", "train_id"]
+}
+#columns upsertTable leaves out of the row hash and the write. vehicle positions change on every poll, so hashing them
+#would rewrite every moving vehicle. they stay in the df for the state index and the snapshots
+UPSERT_SKIPPED_COLUMNS = {
+    "route": POSITION_HEADERS + ["station_distance_m"]
+}
+#secondary indexes and ENUM columns created for each table. primary keys come from TABLE_KEYS when a table is upserted
+TABLE_SCHEMAS = {
+    "line_name": {"indexes": [["line_name"]]},
+    "route": {"indexes": [["route", "vehicle_id"], ["vehicle_id"], ["destination"], ["nearest_station"]], "enums": ["direction"]},
+    "line_metadata": {"indexes": [["line", "train_id"], ["train_id"], ["destination"]], "enums": ["direction"]}
+}
+
+
+def loadJson(body):
+    """ Decodes a JSON body with orjson when it is installed, json otherwise """
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def routeSegments(routes_json):
+    """ Yields (route_id, route_segment) tuples from a decoded routes API response """
+    for route_dict in routes_json["routes"]:
+        for route_id in route_dict.keys():
+            for route_segment in route_dict[route_id]:
+                yield route_id, route_segment
+
+
+def buildDataFrame(rows, headers, dtypes = None, n = 0):
+    """ Builds a dataframe in one pass from a list of row tuples.
+    dtypes is an optional list of dtypes matching headers by position (None keeps the inferred dtype).
+    n is the number of leading rows to leave out. Kept rows keep their original index labels """
+    rows = rows[n:]
+    df = pd.DataFrame.from_records(rows, columns = headers, index = pd.RangeIndex(n, n + len(rows)))
+    if dtypes is not None:
+        df = df.astype({header: dtype for header, dtype in zip(headers, dtypes) if dtype is not None})
+    return df
+
+
+def quoteSqlString(value):
+    """ Quotes a python value as a MySQL string literal """
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "''") + "'"
+
+
+def decodeSql(value):
+    """ Returns value as a str. Older MySQL servers return information_schema values as bytes """
+    return value.decode("utf-8") if isinstance(value, (bytes, bytearray)) else value
+
+
+def varcharType(max_length):
+    """ Returns a VARCHAR sized to the next power of two that fits max_length (at least 16),
+    or TEXT when it does not fit in a utf8mb4 VARCHAR """
+    if max_length > 16383:
+        return "TEXT"
+    size = 16
+    while size < max_length:
+        size *= 2
+    return "VARCHAR({})".format(min(size, 16383))
+
+
+def widenColumnType(current_type, desired_type):
+    """ Returns the MySQL type an existing column should have so it holds both its current values and values of
+    desired_type. VARCHAR lengths and ENUM values are merged. BLOB columns are converted to desired_type """
+    current, desired = current_type.lower(), desired_type.lower()
+    if current == desired or current.startswith(("text", "mediumtext", "longtext")):
+        return current_type
+    if current.startswith("blob"):
+        return desired_type
+    if current.startswith("enum") and desired.startswith("enum"):
+        values = enumValues(current_type)
+        values += [value for value in enumValues(desired_type) if value not in values]
+        return "ENUM({})".format(",".join(quoteSqlString(value) for value in values))
+    if current.startswith("varchar") and desired.startswith("varchar"):
+        length = max(int(current[8:-1]), int(desired[8:-1]))
+        return "VARCHAR({})".format(length)
+    if current.startswith("varchar") and desired.startswith("enum"):
+        length = max([int(current[8:-1])] + [len(value) for value in enumValues(desired_type)])
+        return "VARCHAR({})".format(length)
+    if current.startswith(("int", "bigint")) and desired in ("int", "bigint") and not current.startswith(desired):
+        #never narrow a BIGINT back to INT
+        return "BIGINT"
+    if current.startswith(desired + "("):
+        #the same type with a display width, e.g. int(11)
+        return current_type
+    return desired_type
+
+
+def enumValues(column_type):
+    """ Returns the list of values in an ENUM(...) column type """
+    return [value.replace("''", "'")
+            for value in re.findall(r"'((?:[^']|'')*)'", column_type)]
+
+
+def indexName(columns):
+    """ Returns the name used for a secondary index over columns """
+    return "idx_" + "_".join(columns)
+
+
+def indexColumns(columns, column_types):
+    """ Returns the column list for an index. BLOB and TEXT columns get a 255 character prefix """
+    return ", ".join("`{}`(255)".format(column) if column_types.get(column, "BLOB").lower().endswith(("blob", "text"))
+                     else "`{}`".format(column) for column in columns)
+
+
+def recordParse(frame, start, df):
+    """ Records the parse time (since start) and row count of a load*Df frame in METRICS. Returns df """
+    METRICS.observe("parse_seconds", time.perf_counter() - start, frame=frame)
+    METRICS.setGauge("parse_rows", len(df), frame=frame)
+    return df
+
+
+def toSqlRow(row):
+    """ Converts a dataframe row to values mysql.connector can send.
+    Missing values become NULL, numpy scalars become python numbers and pandas Timestamps become datetimes """
+    values = []
+    for value in row:
+        if pd.isna(value):
+            value = None
+        elif isinstance(value, pd.Timestamp):
+            value = value.to_pydatetime()
+        elif hasattr(value, "item"):
+            value = value.item()
+        values.append(value)
+    return tuple(values)
+
+
+def stationName(destination):
+    """ Returns the regional station name key of a route destination, e.g. "Frankford Transportation Center" -> "Frankford" """
+    #TODO: should we also split station names with " Transit"? maybe splittin on " Trans" is best.
+    return decodeSql(destination).split(" Transportation")[0].strip()
+
+
+def isEmptyArrivals(line_metadata_json):
+    """ True when an arrivals response has no station info, i.e. the API did not recognise the station """
+    return all(station_info == [[], []] for station_info in line_metadata_json.values())
+
+
+class StationResolver():
+    def __init__(self, path = None, rejection_ttl = 86400):
+        """ Maps route destinations to the Regional Rail station names the arrivals API is called with.
+        Station names are learned from the Lines feed (the terminal stations in each line description) and from
+        arrivals responses that returned trains. Names the arrivals API answered with empty station info are kept in
+        a negative cache for rejection_ttl seconds and skipped, so bus destinations are only tried once a day.
+        path is an optional JSON file the mapping is saved to so it survives restarts """
+        self.path = path
+        self.rejection_ttl = rejection_ttl
+        self.lock = threading.Lock()
+        #route destination -> station name key
+        self.destinations = {}
+        #station names confirmed by the Lines feed or by arrivals
+        self.known = set()
+        #station name -> time the arrivals API rejected it
+        self.rejected = {}
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def addLines(self, lines_json):
+        """ Adds the terminal stations named in the Lines feed, e.g. "Paoli/Thorndale" -> Paoli and Thorndale """
+        with self.lock:
+            names = {name.strip() for description in lines_json.get("data", {}).values()
+                     for name in str(description).split("/") if name.strip()}
+            added = names - self.known
+            self.known.update(added)
+            #only destinations whose mapping a new name can change are mapped again, the rest of the saved mapping is kept
+            for destination in [destination for destination in self.destinations
+                                if self.affectedBy(stationName(destination), added)]:
+                del self.destinations[destination]
+        self.save()
+
+    @staticmethod
+    def affectedBy(station, names):
+        """ True when station is one of names or starts with one of them, i.e. station() could map it differently """
+        return station in names or any(station.startswith(name + " ") for name in names)
+
+    def station(self, destination):
+        """ Returns the station name key for a destination. A known station the name starts with wins over the
+        plain stationName split, e.g. "Norristown TC" -> "Norristown" """
+        station = self.destinations.get(destination)
+        if station is None:
+            station = stationName(destination)
+            if station not in self.known:
+                prefixes = [name for name in self.known if station.startswith(name + " ")]
+                if prefixes:
+                    station = max(prefixes, key=len)
+            self.destinations[destination] = station
+        return station
+
+    def resolve(self, destinations):
+        """ Returns the unique station names for destinations in first seen order, leaving out rejected names """
+        now = time.time()
+        stations = []
+        seen = set()
+        skipped = 0
+        with self.lock:
+            for destination in destinations:
+                station = self.station(decodeSql(destination))
+                if station in seen:
+                    continue
+                seen.add(station)
+                rejected_at = self.rejected.get(station)
+                if rejected_at is not None and now - rejected_at < self.rejection_ttl:
+                    skipped += 1
+                    continue
+                stations.append(station)
+        METRICS.increment("station_resolver_skipped_total", skipped)
+        METRICS.setGauge("station_resolver_stations", len(stations))
+        return stations
+
+    def recordResults(self, responses):
+        """ Learns from a list of (station, arrivals json) tuples. Stations answered with empty station info are
+        rejected, stations with trains become known. Failed requests (None) are left alone.
+        When no station in the list has trains the API is more likely in an empty window than every name being wrong,
+        so nothing is rejected """
+        now = time.time()
+        answered = [(station, line_metadata_json) for station, line_metadata_json in responses if line_metadata_json is not None]
+        any_trains = not all(isEmptyArrivals(line_metadata_json) for station, line_metadata_json in answered)
+        with self.lock:
+            for station, line_metadata_json in answered:
+                if isEmptyArrivals(line_metadata_json):
+                    if any_trains and station not in self.known:
+                        self.rejected[station] = now
+                else:
+                    self.known.add(station)
+                    self.rejected.pop(station, None)
+        self.save()
+
+    def load(self):
+        """ Reads the mapping saved by save """
+        try:
+            with open(self.path, encoding="utf-8") as resolver_file:
+                saved = json.load(resolver_file)
+        except (OSError, ValueError) as e:
+            print("Ignoring unreadable station mapping {}: {}".format(self.path, e))
+            return
+        self.destinations = saved.get("destinations", {})
+        self.known = set(saved.get("known", []))
+        self.rejected = saved.get("rejected", {})
+
+    def save(self):
+        """ Writes the mapping to path through a temp file so readers never see half a file """
+        if self.path is None:
+            return
+        with self.lock:
+            saved = {"destinations": self.destinations, "known": sorted(self.known), "rejected": self.rejected}
+            writeJson(self.path, saved)
+
+    def stats(self):
+        """ Returns the number of mapped destinations, known stations and rejected names """
+        return {"destinations": len(self.destinations), "known": len(self.known), "rejected": len(self.rejected)}
+
+
 class SqlUtils():
-    def __init__(self, user_name, password, host, port, db_name):
-        """ Assumes src dest are nodes and weight is a number """
+    def __init__(self, user_name, password, host, port, db_name, chunk_size = 1000, load_data_infile = False,
+                 pool_size = 5, station_resolver = None, retry_policy = None, snapshot_store = None, state_index = None,
+                 station_index = None):
+        """ Stores the MySQL credentials. Every method borrows its connection from one pool
+        of pool_size connections that is created from these credentials on first use, so the
+        user_name, password, host, port and db_name parameters of the other methods are optional
+        and only kept for backwards compatibility.
+        chunk_size and load_data_infile are the defaults used by insertIntoTable
+        station_resolver is an optional StationResolver used by getStations and taught by loadLineMetaDf
+        retry_policy is the RetryPolicy loadLineMetaDf uses when arrivals come back empty or fail
+        snapshot_store is an optional snapshots.SnapshotStore every df loaded by loadTableAllowOverwrite and
+        streamTable is also appended to, one file per load
+        state_index is an optional state.StateIndex kept up to date with the same loads
+        station_index is an optional spatial.StationIndex loadRoutesDf tags vehicles with their nearest station from """
         self.user_name = user_name
         self.password = password
         self.host = host
         self.port = port
         self.db_name = db_name
+        self.chunk_size = chunk_size
+        self.load_data_infile = load_data_infile
+        self.pool_size = pool_size
+        #parameter marker used in generated statements
+        self.placeholder = "%s"
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        #background threads dropping the tables replaced by swapTable, keyed by table name
+        self.drop_threads = {}
+        #row hashes from the last upsertTable load, keyed by table name then by row key
+        self.snapshots = {}
+        #stations whose arrivals request failed during the last loadLineMetaDf call
+        self.failed_stations = []
+        self.station_resolver = station_resolver
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.snapshot_store = snapshot_store
+        self.state_index = state_index
+        self.station_index = station_index
+        #dfs published since the load started, keyed by (table name, captured_at). publishComplete writes them as one file
+        self.snapshot_batches = {}
+        self.snapshot_lock = threading.Lock()
 
     def loadLinesDf(self, json_data, headers, n):
         """ Step 1 - TASK 2: Loads line json into dataframe (df).
         json_data is expected to the lines_json
         headers is a list of strings defining the column headers for the df
         n is an integer defining the number of rows that should be removed from the df"""
-        #load json line data into dataframe
-        df = pd.DataFrame(columns = headers)
+        start = time.perf_counter()
+        #collect the json line data as rows, then build the dataframe once
+        rows = []
         for k in json_data.keys():
             if type(json_data[k]) is dict:
-                newdf = pd.DataFrame.from_records([[k, ""]], columns = headers)
-                df = df.append(newdf,  ignore_index = True)
+                rows.append((k, ""))
         for k in json_data.keys():
             if type(json_data[k]) is dict:
                 new_json = json_data[k]
                 for k in new_json:
-                    newdf = pd.DataFrame.from_records([[k, new_json[k]]], columns = headers)
-                    df = df.append(newdf,  ignore_index = True)
+                    rows.append((k, new_json[k]))
 
         #remove top n rows from dataframe
-        for idx in range(0,n):
-            df = df.drop(index=idx)
-        return df
+        return recordParse("lines", start, buildDataFrame(rows, headers, n = n))
 
     def loadRoutesDf(self, json_data, headers, n):
         """ Step 2 - TASK 2: Loads route json into dataframe (df).
-        json_data is expected to the routes_json
-        headers is a list of strings defining the column headers for the df
-        n is an integer defining the number of rows that should be removed from the df """
-        #load json data into dataframe
-        df = pd.DataFrame(columns = headers)
-        for route_dict in json_data["routes"]:
-            for key in route_dict.keys():
-                route_id = key
-                #step 2 - task 1 cont.
-                route_segments = route_dict[route_id]
-                for route_segment in route_segments:
-                    vehicle_id = route_segment.get("VehicleID")
-                    direction = route_segment.get("Direction")
-                    destination = route_segment.get("destination")
-                    #step 2 - task 2
-                    newdf = pd.DataFrame.from_records([[route_id, vehicle_id, direction, destination]], \
-                                columns = headers)
-                    df = df.append(newdf,  ignore_index = True)
-
-        #remove n top rows from dataframe
-        for idx in range(0,n):
-            df = df.drop(index=idx)
-        return df
+        json_data is expected to the routes_json, or an iterable of (route_id, route_segment) tuples
+        such as ApiUtils.iterRouteSegments
+        headers is a list of strings defining the column headers for the df: route, vehicle id, direction, destination
+        and optionally latitude and longitude (kept as floats)
+        n is an integer defining the number of rows that should be removed from the df
+        With a station_index the vehicles are also tagged with their nearest station and its distance """
+        start = time.perf_counter()
+        segments = routeSegments(json_data) if isinstance(json_data, dict) else json_data
+        #fill one list per column, then build the dataframe once
+        route_ids, vehicle_ids, directions, destinations, lats, lngs = [], [], [], [], [], []
+        #step 2 - task 1 cont.
+        for route_id, route_segment in segments:
+            route_ids.append(route_id)
+            vehicle_ids.append(route_segment.get("VehicleID"))
+            directions.append(route_segment.get("Direction"))
+            destinations.append(route_segment.get("destination"))
+            lats.append(route_segment.get("lat"))
+            lngs.append(route_segment.get("lng"))
+
+        #step 2 - task 2, remove n top rows from dataframe
+        #vehicle ids and coordinates are numeric strings in the feed. store them as nullable integers and floats
+        dtypes = ROUTE_DTYPES
+        raw_ids = pd.Series(vehicle_ids, dtype=object)
+        numeric_ids = pd.to_numeric(raw_ids, errors="coerce")
+        unparsed = int((numeric_ids.isna() & raw_ids.notna()).sum())
+        if unparsed:
+            #keep every id as text instead of storing (or upsertTable dropping) NULL ids. the column becomes a VARCHAR
+            METRICS.increment("route_vehicle_ids_unparsed_total", unparsed)
+            print("{} vehicle ids are not numeric (e.g. {!r}), keeping vehicle_id as text".format(
+                unparsed, raw_ids[numeric_ids.isna() & raw_ids.notna()].iloc[0]))
+            vehicle_ids = [str(vehicle_id) if vehicle_id is not None else None for vehicle_id in vehicle_ids]
+            dtypes = ROUTE_DTYPES[:1] + ["string"] + ROUTE_DTYPES[2:]
+        else:
+            vehicle_ids = numeric_ids.tolist()
+        columns = [route_ids, vehicle_ids, directions, destinations]
+        if len(headers) > len(columns):
+            columns += [pd.to_numeric(pd.Series(lats, dtype=object), errors="coerce").tolist(),
+                        pd.to_numeric(pd.Series(lngs, dtype=object), errors="coerce").tolist()]
+        df = buildDataFrame(list(zip(*columns)), headers, dtypes, n)
+        if self.station_index is not None:
+            df = addNearestStation(df, self.station_index)
+        return recordParse("routes", start, df)
 
-    def loadLineMetaDf(self, column_headers, stations, rec_counter = 1):
+    def iterRoutesBatches(self, segments, headers, batch_size = 5000):
+        """ Consumes (route_id, route_segment) tuples (e.g. from ApiUtils.iterRouteSegments) and
+        yields route dataframes of at most batch_size rows, so a payload never has to be held whole """
+        batch = []
+        for segment in segments:
+            batch.append(segment)
+            if len(batch) >= batch_size:
+                yield self.loadRoutesDf(batch, headers, 0)
+                batch = []
+        if batch:
+            yield self.loadRoutesDf(batch, headers, 0)
+
+    def loadLineMetaDf(self, column_headers, stations, rec_counter = 1, max_workers = 8, api = None, retry_policy = None):
         """For each station name, calls the line metadata API to get the arrival information.
         Returns None if station information is not found by API. For Stations found by API,
         parses line metadata json and loads the data into a pandas dataframe for each arrival found.
-        If no station names from the getStations list are returned, the routes table is refreshed,
-        a new getStations list is generated, line metadata then attempts to load into a df again"""
-        api = ApiUtils()
-        #create lines metadata dataframe
-        df = pd.DataFrame(columns = column_headers)
-
-        if rec_counter > 3:
-            print("Cannot find any Regional Station names in Line Metadata Feed. Tried 3 times.")
-            return df
-        #for each station name, make API call
-        for station in stations:
-            line_metadata_json = api.getLineMetadata(station)
+        The API calls are fanned out over max_workers threads, rows keep the order of stations and
+        stations whose request failed are recorded in self.failed_stations.
+        Retries follow retry_policy (defaults to self.retry_policy) with backoff between rounds:
+        if no station returned arrivals, the station candidates are rebuilt in memory from the TransitView snapshot
+        (a fresh cached one when there is one, without rewriting the route table) and every candidate is asked again,
+        bypassing the response cache. If only some stations failed, just those are retried.
+        rec_counter is the round to start from, kept for callers of the old recursive version
+        api is the ApiUtils used for the calls (defaults to a new ApiUtils on the shared client and cache)"""
+        api = api if api is not None else ApiUtils()
+        retry_policy = retry_policy if retry_policy is not None else self.retry_policy
+        stations = list(stations)
+        pending = stations
+        responses = {}
+        df = buildDataFrame([], column_headers, LINE_METADATA_DTYPES)
+        for attempt in range(rec_counter, retry_policy.attempts + 1):
+            METRICS.increment("line_metadata_attempts_total")
+            #make the API calls for the pending station names concurrently. retries skip the cached answers
+            results, failed_stations = api.getLineMetadataMany(pending, max_workers=max_workers,
+                                                               use_cache=attempt == rec_counter)
+            responses.update(results)
+            if self.station_resolver is not None:
+                self.station_resolver.recordResults(results)
+            self.failed_stations = [station for station in stations if responses.get(station) is None]
+            METRICS.setGauge("line_metadata_failed_stations", len(self.failed_stations))
+            df = self.parseLineMetadata([(station, responses.get(station)) for station in stations], column_headers)
+
+            if not df.empty and not (retry_policy.retry_failed and self.failed_stations):
+                return df
+            if attempt >= retry_policy.attempts:
+                break
+            if df.empty:
+                #no arrivals at all. rebuild the station candidates from the routes feed and ask all of them again
+                METRICS.increment("line_metadata_fallbacks_total")
+                candidates = self.stationsFromRoutes(api.getRoutes())
+                stations = list(dict.fromkeys(stations + candidates))
+                pending = stations
+            else:
+                METRICS.increment("line_metadata_station_retries_total", len(self.failed_stations))
+                pending = self.failed_stations
+            if not pending:
+                break
+            time.sleep(retry_policy.delay(attempt))
+
+        if df.empty:
+            METRICS.increment("line_metadata_exhausted_total")
+            print("Cannot find any Regional Station names in Line Metadata Feed. Tried {} times.".format(retry_policy.attempts))
+        return df
+
+    def stationsFromRoutes(self, routes_json):
+        """ Returns the station names for the destinations in a routes API response, like getStations does for the route table """
+        if routes_json is None:
+            return []
+        return self.resolveStations(route_segment.get("destination") for route_id, route_segment in routeSegments(routes_json)
+                                    if route_segment.get("destination") is not None)
+
+    def resolveStations(self, destinations):
+        """ Maps destinations to unique station names with the station_resolver, or with stationName when there is none """
+        if self.station_resolver is not None:
+            return self.station_resolver.resolve(destinations)
+        #dict keys keep the first seen order
+        return list(dict.fromkeys(stationName(destination) for destination in destinations))
+
+    def iterLineMetadataBatches(self, responses, column_headers, batch_size = 10):
+        """ Consumes (station, line metadata json) tuples as they arrive (e.g. from ApiUtils.iterLineMetadata)
+        and yields a line metadata dataframe for every batch_size stations that returned arrivals.
+        Stations whose request failed are recorded in self.failed_stations and the station_resolver
+        learns from each batch """
+        self.failed_stations = []
+        def parse(batch):
+            self.failed_stations.extend(station for station, line_metadata_json in batch if line_metadata_json is None)
+            if self.station_resolver is not None:
+                self.station_resolver.recordResults(batch)
+            return self.parseLineMetadata(batch, column_headers)
+
+        batch = []
+        for response in responses:
+            batch.append(response)
+            if len(batch) >= batch_size:
+                df = parse(batch)
+                batch = []
+                if not df.empty:
+                    yield df
+        if batch:
+            df = parse(batch)
+            if not df.empty:
+                yield df
+        METRICS.setGauge("line_metadata_failed_stations", len(self.failed_stations))
+
+    def iterLineMetadataWithRetries(self, api, stations, column_headers, max_workers = 8, retry_policy = None):
+        """ Streams the arrivals of stations as line metadata dataframes like iterLineMetadataBatches, then retries the
+        stations whose request failed following retry_policy (defaults to self.retry_policy), bypassing the response
+        cache with backoff between rounds, and yields their batches too. Everything lands in the same shadow table
+        before streamTable promotes it. When no station returned arrivals nothing is retried here, the caller falls
+        back to loadLineMetaDf which rebuilds the station candidates """
+        retry_policy = retry_policy if retry_policy is not None else self.retry_policy
+        any_rows = False
+        for attempt in range(1, retry_policy.attempts + 1):
+            if attempt > 1:
+                if not (any_rows and retry_policy.retry_failed and self.failed_stations):
+                    break
+                METRICS.increment("line_metadata_station_retries_total", len(self.failed_stations))
+                time.sleep(retry_policy.delay(attempt - 1))
+            METRICS.increment("line_metadata_attempts_total")
+            pending = stations if attempt == 1 else self.failed_stations
+            responses = api.iterLineMetadata(pending, max_workers=max_workers, use_cache=attempt == 1)
+            for df in self.iterLineMetadataBatches(responses, column_headers):
+                any_rows = True
+                yield df
+
+    def parseLineMetadata(self, responses, column_headers):
+        """ Parses a list of (station, line metadata json) tuples into the line metadata dataframe.
+        Stations without a response or with empty station info are skipped """
+        start = time.perf_counter()
+        rows = []
+        for station, line_metadata_json in responses:
             #pprint(line_metadata_json)
 
-            #load API response into Pandas
+            #collect API response as rows
             if line_metadata_json is not None:
                 for key in line_metadata_json.keys():
                     full_station_info = line_metadata_json[key]
@@ -138,268 +977,542 @@ class SqlUtils():
                                 origin = arrival.get("origin")
                                 destination = arrival.get("destination")
                                 train_id = arrival.get("train_id")
-                                newdf = pd.DataFrame.from_records([[line, direction, origin, destination, train_id]],\
-                                            columns = column_headers)
-                                df = df.append(newdf,  ignore_index = True)
+                                rows.append((line, direction, origin, destination, train_id))
 
-#         #if lines metadata is completely empty. grab routes data again
-        if df.empty:
-            routes_json = api.getRoutes()
-            routes_df = self.loadRoutesDf(routes_json, ["route", "vehicle_id", "direction", "destination" ], 0)
-            self.loadTableAllowOverwrite(routes_df, "route", self.user_name, self.password, self.host, self.port, self.db_name)
-            stations = self.getStations("route", self.user_name, self.password, self.host, self.port, self.db_name)
-            return self.loadLineMetaDf(column_headers, stations, rec_counter+1 )
-        else:
-            return df
-        return df
+        #create lines metadata dataframe
+        return recordParse("line_metadata", start, buildDataFrame(rows, column_headers, LINE_METADATA_DTYPES))
 
-    def createDatabase(self, user_name, password, host, port, db_name):
+    def createDatabase(self, user_name = None, password = None, host = None, port = None, db_name = None):
         """ Checks to see if the database name exists for a given MySQL connection.
-        If the database name does not exist, a new database is created with that name"""
+        If the database name does not exist, a new database is created with that name.
+        Uses its own short lived connection since the pooled connections are opened on the database"""
         #connect to MySQL server
+        myconnection = mysql_connector.connect(
+            host=self.host,
+            port=self.port,
+            user=self.user_name,
+            password=self.password
+        )
         try:
-            myconnection = connect(
-                host=host,
-                port=port,
-                user=user_name,
-                password=password
-            )
-        except Error as e:
-            print(e)
-
-        #load all database names into cursor
-        mycursor = myconnection.cursor()
-        mycursor.execute("SHOW DATABASES")
-
-        db_exists = False
-
-        #determine if database name already exists
-        for found_db in mycursor:
-            #note: db_name prints as tuple, ('septa_transit',)
-            if db_name in found_db:
-                db_exists = True
+            #create the database if it is missing. the connection is only needed once
+            mycursor = myconnection.cursor()
+            mycursor.execute("CREATE DATABASE IF NOT EXISTS `{}`".format(self.db_name))
+            mycursor.close()
+        finally:
+            myconnection.close()
+        return
+
+    def getPool(self):
+        """ Returns the MySQL connection pool, creating the database and the pool on first use """
+        with self.pool_lock:
+            if self.pool is None:
+                self.createDatabase()
+                self.pool = mysql_connector.pooling.MySQLConnectionPool(
+                    pool_size=self.pool_size,
+                    host=self.host,
+                    port=self.port,
+                    user=self.user_name,
+                    password=self.password,
+                    database=self.db_name,
+                    allow_local_infile=self.load_data_infile
+                )
+            return self.pool
+
+    @contextmanager
+    def connection(self, timeout = 30):
+        """ Borrows a connection from the pool and returns it when the with block exits.
+        Waits up to timeout seconds for a connection when all pooled connections are in use """
+        pool = self.getPool()
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                myconnection = pool.get_connection()
                 break
-                mycursor.close()
-                return
+            except mysql_connector.errors.PoolError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        try:
+            yield myconnection
+        finally:
+            #close() on a pooled connection hands it back to the pool
+            myconnection.close()
 
-        #if database name is not found, make database
-        if not(db_exists):
-            execute_string = "CREATE DATABASE IF NOT EXISTS {}".format(db_name)
-            mycursor.execute(execute_string)
-            mycursor.close()
-            return
+    def close(self):
+        """ Waits for background table drops, then closes the idle connections held by the pool """
+        self.waitForDrops()
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool._remove_connections()
+                self.pool = None
 
-    def tableExists(self, table_name, user_name, password, host, port, db_name):
+    def tableExists(self, table_name, user_name = None, password = None, host = None, port = None, db_name = None):
         """ Determine if the table exists in the database.
         Returns Boolean. True is table_name is found. False table_name not found"""
-        #ensure the database exists, if not makes a database
-        #TODO: enhance to fail if db_name is not found
-        self.createDatabase(user_name, password, host, port, db_name)
-        #start by assuming the table name does not exist
-        table_exists = False
-        #connect to MySQL server
-        try:
-            myconnection = connect(
-                host=host,
-                port=port,
-                user=user_name,
-                password=password,
-                database=db_name
-            )
-        except Error as e:
-            print(e)
-
-        #load all table names into cursor
-        mycursor = myconnection.cursor()
-        mycursor.execute("SHOW TABLES")
-
-        #determine if table name already exists
-        for found_table in mycursor:
+        with self.connection() as myconnection:
+            mycursor = myconnection.cursor()
+            #escape _ so it is not treated as a LIKE wildcard
+            mycursor.execute("SHOW TABLES LIKE %s", (table_name.replace("_", "\\_"),))
             #each table name prints as tuple, ('line_name',)
-            if table_name in found_table:
-                table_exists = True
-                break
-                mycursor.close()
-
+            table_exists = mycursor.fetchone() is not None
+            mycursor.close()
         return table_exists
         
-    def createTableStatement(self, table_name, column_headers):
+    def inferColumnTypes(self, dataframe, enum_columns = ()):
+        """ Maps each df column to a MySQL column type based on its dtype.
+        Integers become INT or BIGINT, floats DOUBLE, datetimes DATETIME and booleans TINYINT(1).
+        Categorical columns listed in enum_columns become an ENUM of their categories.
+        Other columns become a VARCHAR sized to the longest value (TEXT if it is too long or the values are not strings)
+        Returns a dict of column header to MySQL type """
+        column_types = {}
+        for column in dataframe.columns:
+            series = dataframe[column]
+            dtype = series.dtype
+            if pd.api.types.is_bool_dtype(dtype):
+                column_types[column] = "TINYINT(1)"
+            elif pd.api.types.is_integer_dtype(dtype):
+                values = series.dropna()
+                fits_int = values.empty or (values.min() >= -2**31 and values.max() < 2**31)
+                column_types[column] = "INT" if fits_int else "BIGINT"
+            elif pd.api.types.is_float_dtype(dtype):
+                column_types[column] = "DOUBLE"
+            elif pd.api.types.is_datetime64_any_dtype(dtype):
+                column_types[column] = "DATETIME"
+            elif isinstance(dtype, pd.CategoricalDtype) and column in enum_columns and len(dtype.categories):
+                column_types[column] = "ENUM({})".format(",".join(quoteSqlString(value) for value in dtype.categories))
+            else:
+                values = series.dropna()
+                if all(isinstance(value, str) for value in values):
+                    column_types[column] = varcharType(values.str.len().max() if len(values) else 0)
+                else:
+                    column_types[column] = "TEXT"
+        return column_types
+
+    def createTableStatement(self, table_name, column_headers, primary_key = None, column_types = None, indexes = None):
         """ Generates the string needed to execute a MySQL CREATE TABLE statement.
-            column_headers is a list. Each column header is loaded into the table as a BLOB datatype.
+            column_headers is a list. column_types is a dict of column header to MySQL type (see inferColumnTypes).
+            Columns without a type are loaded into the table as a BLOB datatype.
             BLOB in MySQL provides the same amount of storage as Microsoft's VARCHAR(MAX)
+            primary_key is an optional list of column headers. indexes is an optional list of column header lists,
+            one per secondary index. BLOB and TEXT columns are indexed on a 255 character prefix
         """
-        if len(column_headers) == 1:
-            create_table = "CREATE TABLE IF NOT EXISTS {} ({} BLOB )".format(table_name, header[0])
-        else: 
-            string_list = []
-            string_start = "CREATE TABLE IF NOT EXISTS {} (".format(table_name)
-            string_list.append(string_start)
-            string_end = ")"
-            for i in range(len(column_headers)):
-
-                header_string = " {} BLOB,".format(column_headers[i])
-                if i == len(column_headers)-1:
-                    header_string = header_string[:-1]
-                string_list.append(header_string)
-
-            string_list.append(string_end)
-
-            create_table = ''.join(string_list)
+        column_types = column_types or {}
+        definitions = ["`{}` {}".format(column, column_types.get(column, "BLOB")) for column in column_headers]
+        if primary_key:
+            definitions.append("PRIMARY KEY ({})".format(indexColumns(primary_key, column_types)))
+        for index in indexes or []:
+            #the primary key already covers an index on its leading columns
+            if primary_key and list(primary_key[:len(index)]) == list(index):
+                continue
+            definitions.append("INDEX `{}` ({})".format(indexName(index), indexColumns(index, column_types)))
+        create_table = "CREATE TABLE IF NOT EXISTS `{}` ({})".format(table_name, ", ".join(definitions))
         return create_table
 
-    def createTable(self, dataframe, table_name, user_name, password, host, port, db_name):
+    def createTable(self, dataframe, table_name, user_name = None, password = None, host = None, port = None, db_name = None,
+                    primary_key = None, schema_table = None):
         """ Creates a table using the given table_name in the MySQL connection provided.
-        dataframe is expected to be a pandas df.
-        All parameters are required. No defaults are set.
+        dataframe is expected to be a pandas df. Column types are inferred from its dtypes.
+        Secondary indexes and ENUM columns come from the TABLE_SCHEMAS entry for schema_table (defaults to table_name).
+        primary_key is an optional list of column headers
         """
-        #ensure the database exists, if not makes a database
-        self.createDatabase(user_name, password, host, port, db_name)
-
         column_headers = dataframe.columns.tolist()
+        schema = TABLE_SCHEMAS.get(schema_table or table_name, {})
+        column_types = self.inferColumnTypes(dataframe, schema.get("enums", ()))
+        indexes = [index for index in schema.get("indexes", []) if set(index) <= set(column_headers)]
 
-        #connect to MySQL server
-        try:
-            myconnection = connect(
-                host=host,
-                port=port,
-                user=user_name,
-                password=password,
-                database=db_name
-            ) 
-        except Error as e:
-            print(e)
-
-        #initiate cursor
-        mycursor = myconnection.cursor()
-
-        #execute create table statement
-        create_table_statement = self.createTableStatement(table_name, column_headers)
-        mycursor.execute(create_table_statement)
-        mycursor.close()
-
+        with self.connection() as myconnection:
+            #initiate cursor
+            mycursor = myconnection.cursor()
+            #execute create table statement
+            create_table_statement = self.createTableStatement(table_name, column_headers, primary_key, column_types, indexes)
+            mycursor.execute(create_table_statement)
+            mycursor.close()
         return
+
+    def migrateTable(self, dataframe, table_name, primary_key = None, schema_table = None):
+        """ Brings an existing table in line with the column types inferred from the df with one ALTER TABLE.
+        Missing columns are added, VARCHARs and ENUMs are widened to fit the new values, BLOB columns left by older
+        versions are converted to their typed columns, and missing secondary indexes (TABLE_SCHEMAS entry for schema_table,
+        defaults to table_name) and primary key are added.
+        Returns the list of changes applied """
+        schema = TABLE_SCHEMAS.get(schema_table or table_name, {})
+        desired_types = self.inferColumnTypes(dataframe, schema.get("enums", ()))
+        current_types = {decodeSql(name): decodeSql(column_type) for name, column_type in self.readTable(
+            table_name, select_statement="SELECT COLUMN_NAME, COLUMN_TYPE FROM information_schema.COLUMNS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = '{}'".format(table_name), toPrint=False)}
+        current_indexes = {decodeSql(row[2]) for row in self.readTable(
+            table_name, select_statement="SHOW INDEX FROM `{}`".format(table_name), toPrint=False)}
+
+        changes = []
+        for column, desired_type in desired_types.items():
+            current_type = current_types.get(column)
+            if current_type is None:
+                changes.append("ADD COLUMN `{}` {}".format(column, desired_type))
+                current_types[column] = desired_type
+                continue
+            merged_type = widenColumnType(current_type, desired_type)
+            if merged_type.lower() != current_type.lower():
+                changes.append("MODIFY COLUMN `{}` {}".format(column, merged_type))
+            current_types[column] = merged_type
+        if primary_key and "PRIMARY" not in current_indexes:
+            changes.append("ADD PRIMARY KEY ({})".format(indexColumns(primary_key, current_types)))
+        for index in schema.get("indexes", []):
+            if primary_key and list(primary_key[:len(index)]) == list(index):
+                continue
+            if indexName(index) not in current_indexes and set(index) <= set(current_types):
+                changes.append("ADD INDEX `{}` ({})".format(indexName(index), indexColumns(index, current_types)))
+
+        if changes:
+            with self.connection() as myconnection:
+                mycursor = myconnection.cursor()
+                mycursor.execute("ALTER TABLE `{}` {}".format(table_name, ", ".join(changes)))
+                mycursor.close()
+            print("Migrated {}: {}".format(table_name, changes))
+        return changes
         
-    def readTable(self, table_name, user_name, password, host, port, db_name, select_statement = None, toPrint = True):
+    def readTable(self, table_name, user_name = None, password = None, host = None, port = None, db_name = None,
+                  select_statement = None, toPrint = True):
         """ Connects to MySQL and outputs the table to enable reading in terminal """
 
         if select_statement is None:
             select_statement = "SELECT * FROM `" + table_name + "`"
-        #connect to MySQL server
-        try:
-            myconnection = connect(
-                host=host,
-                port=port,
-                user=user_name,
-                password=password,
-                database=db_name
-            ) 
-        except Error as e:
-            print(e)
-
-        #initiate cursor
-        mycursor = myconnection.cursor()
-
-        mycursor.execute(select_statement)
-        # read all table records
-        result = mycursor.fetchall()
+        with self.connection() as myconnection:
+            #initiate cursor
+            mycursor = myconnection.cursor()
+            mycursor.execute(select_statement)
+            # read all table records
+            result = mycursor.fetchall()
+            mycursor.close()
         if toPrint:
             for i in result:
                 print(i)
-
-        mycursor.close()
         return result
 
-    def dropTable(self, table_name, user_name, password, host, port, db_name):
-        """ Drops the table name in the MySQL connection provided. """
-        #ensure the database exists
-        self.createDatabase(user_name, password, host, port, db_name)
-
-        #connect to MySQL server
-        try:
-            myconnection = connect(
-                host=host,
-                port=port,
-                user=user_name,
-                password=password,
-                database=db_name
-            ) 
-        except Error as e:
-            print(e)
-
-        #initiate cursor
-        mycursor = myconnection.cursor()
-        #execute drop table statement
-        execute_string = "DROP TABLE {}".format(table_name)
-        mycursor.execute(execute_string)
-        mycursor.close()
+    def dropTable(self, table_name, user_name = None, password = None, host = None, port = None, db_name = None,
+                  if_exists = False):
+        """ Drops the table name in the MySQL connection provided.
+        if_exists makes dropping a missing table a no-op """
+        with self.connection() as myconnection:
+            #initiate cursor
+            mycursor = myconnection.cursor()
+            #execute drop table statement
+            execute_string = "DROP TABLE {}`{}`".format("IF EXISTS " if if_exists else "", table_name)
+            mycursor.execute(execute_string)
+            mycursor.close()
         return
 
-    def insertIntoTable(self, dataframe, table_name, user_name, password, host, port, db_name):
-        """ Inserts rows from Pandas DF into the table name in the MySQL connection provided. """
-        #connect to MySQL server
-        try:
-            myconnection = connect(
-                host=host,
-                port=port,
-                user=user_name,
-                password=password,
-                database=db_name
-            ) 
-        except Error as e:
-            print(e)
-
-        #initiate cursor
-        mycursor = myconnection.cursor()
+    def insertIntoTable(self, dataframe, table_name, user_name = None, password = None, host = None, port = None,
+                        db_name = None, chunk_size = None, load_data_infile = None):
+        """ Inserts rows from Pandas DF into the table name in the MySQL connection provided.
+        Rows are sent with executemany in batches of chunk_size and committed in a single transaction.
+        If load_data_infile is True, the df is written to a CSV file and loaded with LOAD DATA LOCAL INFILE
+        (the MySQL server must have local_infile enabled and SqlUtils must be created with load_data_infile=True
+        so the pooled connections allow it).
+        chunk_size and load_data_infile default to the values given to SqlUtils.
+        Returns a dict with the rows loaded, seconds taken and rows per second """
+        start = time.monotonic()
+        chunk_size = chunk_size or self.chunk_size
+        load_data_infile = self.load_data_infile if load_data_infile is None else load_data_infile
 
         # creating column list for inserting into table
         cols = "`,`".join([str(i) for i in dataframe.columns.tolist()])
+        rows = [toSqlRow(row) for row in dataframe.itertuples(index=False, name=None)]
 
-        for i, row in dataframe.iterrows():
-            #make insert statement string for inserting into table
-            insert_into = "INSERT INTO `" + table_name + "` (`" + cols + "`) VALUES (" + "%s," *(len(row)-1) + "%s)"
-            #insert each row into the table
-            mycursor.execute(insert_into, tuple(row)) 
-            #commit changes. the connection is not autocommitted by default. must commit to save changes
-            myconnection.commit()
+        with self.connection() as myconnection:
+            #initiate cursor
+            mycursor = myconnection.cursor()
+            round_trips = 0
+            try:
+                if load_data_infile:
+                    self.loadDataInfile(mycursor, rows, table_name, cols)
+                    round_trips += 1
+                else:
+                    #make insert statement string once for inserting into table
+                    insert_into = "INSERT INTO `" + table_name + "` (`" + cols + "`) VALUES (" \
+                                  + ",".join([self.placeholder] * len(dataframe.columns)) + ")"
+                    for i in range(0, len(rows), chunk_size):
+                        mycursor.executemany(insert_into, rows[i:i + chunk_size])
+                        round_trips += 1
+                #commit changes once for the whole table. the connection is not autocommitted by default
+                with METRICS.timer("sql_commit_seconds", table=table_name):
+                    myconnection.commit()
+                round_trips += 1
+            except mysql_connector.Error:
+                myconnection.rollback()
+                raise
+            finally:
+                mycursor.close()
 
-        mycursor.close()
-        return
+        seconds = time.monotonic() - start
+        METRICS.observe("sql_insert_seconds", seconds, table=table_name)
+        METRICS.increment("sql_round_trips_total", round_trips, table=table_name)
+        METRICS.increment("sql_rows_written_total", len(rows), table=table_name)
+        stats = {"rows": len(rows), "seconds": seconds, "rows_per_second": len(rows) / seconds if seconds else None}
+        print("Loaded {} rows into {} in {:.3f}s ({:.0f} rows/s)".format(
+            len(rows), table_name, seconds, stats["rows_per_second"] or 0))
+        return stats
 
-    def loadTableNoOverwrite(self, dataframe, table_name, user_name, password, host, port, db_name):
+    def loadDataInfile(self, mycursor, rows, table_name, cols):
+        """ Writes rows to a temporary CSV file and streams it to MySQL with LOAD DATA LOCAL INFILE.
+        mysql.connector can only send local files by path, so the CSV goes through a temp file """
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", newline="", encoding="utf-8", delete=False) as csv_file:
+            writer = csv.writer(csv_file, lineterminator="\n")
+            for row in rows:
+                #\N is MySQL's NULL marker. backslashes in values are escaped for ESCAPED BY '\\'
+                writer.writerow(["\\N" if value is None else str(value).replace("\\", "\\\\") for value in row])
+        try:
+            load_data = "LOAD DATA LOCAL INFILE %s INTO TABLE `" + table_name + "` CHARACTER SET utf8mb4 " \
+                        "FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' ESCAPED BY '\\\\' " \
+                        "LINES TERMINATED BY '\\n' (`" + cols + "`)"
+            mycursor.execute(load_data, (csv_file.name,))
+        finally:
+            os.remove(csv_file.name)
+
+    def loadTableNoOverwrite(self, dataframe, table_name, user_name = None, password = None, host = None, port = None,
+                             db_name = None):
         """ Checks if the table exists.
-        If the table exists - No action is taken. This function does not allow overwriting tables.
+        If the table exists - No rows are written. This function does not allow overwriting tables. The table is only
+        migrated (migrateTable) so tables left by older versions get their typed columns and indexes.
         If the table does not exist - A table is created, data is inserted into the new table from the df"""
-        table_exists = self.tableExists(table_name, user_name, password, host, port, db_name)
+        table_exists = self.tableExists(table_name)
         if not(table_exists):
-            self.createTable(dataframe, table_name, user_name, password, host, port, db_name)
-            self.insertIntoTable(dataframe, table_name, user_name, password, host, port, db_name)
+            self.createTable(dataframe, table_name)
+            self.insertIntoTable(dataframe, table_name)
+        else:
+            self.migrateTable(dataframe, table_name)
         return
 
-    def loadTableAllowOverwrite(self, dataframe, table_name, user_name, password, host, port, db_name):
-        """ Checks if the table exists.
-        If the table exists. The table is dropped, a new one is created, data is inserted into the table from the df .
-        If the table does not exist - A table is created, data is inserted into the new table from the df"""
-        table_exists = self.tableExists(table_name, user_name, password, host, port, db_name)
-        if table_exists:
-            self.dropTable(table_name, user_name, password, host, port, db_name)
-            self.createTable(dataframe, table_name, user_name, password, host, port, db_name)
-            self.insertIntoTable(dataframe, table_name, user_name, password, host, port, db_name)
-        if not(table_exists):
-            self.createTable(dataframe, table_name, user_name, password, host, port, db_name)
-            self.insertIntoTable(dataframe, table_name, user_name, password, host, port, db_name)
+    def loadTableAllowOverwrite(self, dataframe, table_name, user_name = None, password = None, host = None, port = None,
+                                db_name = None, mode = "swap"):
+        """ Replaces the contents of the table with the df.
+        mode "swap" (default) - The df is loaded into a shadow table (<table_name>_new) and swapped in with a single
+        atomic RENAME TABLE, so readers never see a missing or half loaded table. The old table is dropped in the background.
+        mode "drop" - If the table exists, it is dropped, a new one is created, data is inserted into the table from the df.
+        If the table does not exist - A table is created, data is inserted into the new table from the df
+        mode "upsert" - Only the rows that were inserted, changed or deleted since the last load are written (see upsertTable)
+        The df is also published to the snapshot_store and state_index when there are ones"""
+        captured_at = datetime.now(timezone.utc)
+        self.publish(dataframe, table_name, captured_at)
+        self.publishComplete(table_name, captured_at)
+        with METRICS.timer("sql_table_load_seconds", table=table_name, mode=mode):
+            if mode == "swap":
+                self.swapTable(dataframe, table_name)
+            elif mode == "upsert":
+                self.upsertTable(dataframe, table_name)
+            else:
+                table_exists = self.tableExists(table_name)
+                if table_exists:
+                    self.dropTable(table_name)
+                self.createTable(dataframe, table_name)
+                self.insertIntoTable(dataframe, table_name)
         return
 
-    def getStations(self, table_name, user_name, password, host, port, db_name):
-        """ Reads the route table created in MySQL. Selects description column and
-        parses column using pattern matching to generate the regional station name key.
-        Outputs a list of regional station names"""
-        stations = []
-        select_statement = "SELECT destination FROM `" + table_name + "`"
-        destinations = self.readTable(table_name, user_name, password, host, port, db_name, select_statement, False)
-        for destination in destinations:
-            #TODO: should we also split station names with " Transit"? maybe splittin on " Trans" is best.
-            station_name = destination[0].decode("utf-8").split(" Transportation")[0]
-            if station_name not in stations:
-                stations.append(station_name)
-        return stations
+    def publish(self, dataframe, table_name, captured_at):
+        """ Adds the df (or one batch of a streamed load) to the state_index and keeps it for the snapshot_store,
+        if there are ones. Nothing is written to the snapshot_store until publishComplete """
+        if self.state_index is not None:
+            self.state_index.update(dataframe, table_name, captured_at)
+        if self.snapshot_store is None:
+            return
+        with self.snapshot_lock:
+            self.snapshot_batches.setdefault((table_name, captured_at), []).append(dataframe)
+
+    def publishComplete(self, table_name, captured_at):
+        """ Marks the load stamped captured_at as complete, dropping the state_index records that were not in it, and
+        appends the batches published for it to the snapshot_store as one file.
+        A failed snapshot write is reported without failing the load """
+        if self.state_index is not None:
+            self.state_index.prune(table_name, captured_at)
+        if self.snapshot_store is None:
+            return
+        with self.snapshot_lock:
+            batches = self.snapshot_batches.pop((table_name, captured_at), [])
+            #batches left over by an earlier load of the table that failed half way are never written
+            for key in [key for key in self.snapshot_batches if key[0] == table_name and key[1] < captured_at]:
+                del self.snapshot_batches[key]
+        if not batches:
+            return
+        dataframe = batches[0] if len(batches) == 1 else pd.concat(batches, ignore_index=True)
+        try:
+            self.snapshot_store.append(dataframe, table_name, captured_at)
+        except (OSError, TypeError, ValueError) as e:
+            print("Could not snapshot {}: {}".format(table_name, e))
+
+    def swapTable(self, dataframe, table_name, primary_key = None):
+        """ Loads the df into <table_name>_new, then renames <table_name> to <table_name>_old and
+        <table_name>_new to <table_name> in one statement. <table_name>_old is dropped on a background thread.
+        primary_key is passed on to createTable """
+        shadow_table = self.prepareShadowTable(table_name)
+        #the bulk load runs against the shadow table, so readers of table_name are not blocked
+        self.createTable(dataframe, shadow_table, primary_key = primary_key, schema_table = table_name)
+        self.insertIntoTable(dataframe, shadow_table)
+        self.promoteShadowTable(table_name)
+        return
+
+    def streamTable(self, batches, table_name):
+        """ Replaces the table with the rows of an iterable of dataframes (e.g. iterRoutesBatches) without holding them all.
+        Each batch is written to <table_name>_new as it arrives, widening columns when a later batch needs it,
+        then the shadow table is swapped in as in swapTable. With a snapshot_store the batches are kept until the load
+        completes so they are snapshotted as one file. Returns the number of rows loaded """
+        enum_columns = TABLE_SCHEMAS.get(table_name, {}).get("enums", ())
+        shadow_table = None
+        column_types = {}
+        rows = 0
+        #every batch of one load shares the snapshot time
+        captured_at = datetime.now(timezone.utc)
+        for batch in batches:
+            self.publish(batch, table_name, captured_at)
+            batch_types = self.inferColumnTypes(batch, enum_columns)
+            if shadow_table is None:
+                shadow_table = self.prepareShadowTable(table_name)
+                self.createTable(batch, shadow_table, schema_table = table_name)
+                column_types = batch_types
+            else:
+                widened_types = {column: widenColumnType(column_types[column], column_type) if column in column_types
+                                 else column_type for column, column_type in batch_types.items()}
+                #only ALTER the shadow table when this batch does not fit the columns created so far
+                if any(column_types.get(column) != column_type for column, column_type in widened_types.items()):
+                    self.migrateTable(batch, shadow_table, schema_table = table_name)
+                    column_types.update(widened_types)
+            self.insertIntoTable(batch, shadow_table)
+            rows += len(batch)
+        if shadow_table is None:
+            print("No rows to load into {}. Keeping the current table".format(table_name))
+            return 0
+        self.publishComplete(table_name, captured_at)
+        self.promoteShadowTable(table_name)
+        return rows
+
+    def prepareShadowTable(self, table_name):
+        """ Clears <table_name>_new and <table_name>_old for a new swap. Returns the shadow table name """
+        #the previous refresh may still be dropping its old table
+        self.waitForDrops(table_name)
+        self.dropTable(table_name + "_new", if_exists = True)
+        self.dropTable(table_name + "_old", if_exists = True)
+        return table_name + "_new"
+
+    def promoteShadowTable(self, table_name):
+        """ Swaps the loaded <table_name>_new in for <table_name> with one RENAME TABLE.
+        The replaced table is dropped on a background thread """
+        shadow_table = table_name + "_new"
+        old_table = table_name + "_old"
+        table_exists = self.tableExists(table_name)
+        with self.connection() as myconnection:
+            mycursor = myconnection.cursor()
+            if table_exists:
+                #RENAME TABLE swaps both names atomically
+                mycursor.execute("RENAME TABLE `{0}` TO `{1}`, `{2}` TO `{0}`".format(table_name, old_table, shadow_table))
+                drop_thread = threading.Thread(target=self.dropTable, args=(old_table,), kwargs={"if_exists": True},
+                                               name="drop-" + old_table, daemon=True)
+                drop_thread.start()
+                self.drop_threads[table_name] = drop_thread
+            else:
+                mycursor.execute("RENAME TABLE `{}` TO `{}`".format(shadow_table, table_name))
+            mycursor.close()
+        return
 
+    def upsertTable(self, dataframe, table_name, key_columns = None):
+        """ Incrementally syncs the table with the df instead of rewriting it.
+        Each row is keyed by key_columns (defaults to TABLE_KEYS[table_name]) and hashed. The hashes are compared with the
+        snapshot kept from the previous load, and only new and changed rows are written with INSERT ... ON DUPLICATE KEY UPDATE
+        while rows whose key disappeared are deleted, all in one transaction. The table gets first_seen and modified_at columns.
+        Without a snapshot (first load in this process) every row is upserted and keys missing from the df are deleted.
+        Columns in UPSERT_SKIPPED_COLUMNS[table_name] are not hashed or written.
+        Returns a dict with the number of inserted, updated and deleted rows """
+        key_columns = key_columns or TABLE_KEYS[table_name]
+        now = datetime.now().replace(microsecond=0)
+        dataframe = dataframe.drop(columns=[column for column in UPSERT_SKIPPED_COLUMNS.get(table_name, [])
+                                            if column in dataframe.columns])
+        #rows without a full key cannot be tracked. the last row wins when a key repeats
+        dataframe = dataframe.dropna(subset=key_columns).drop_duplicates(subset=key_columns, keep="last")
+        data_columns = dataframe.columns.tolist()
+        keys = list(zip(*[dataframe[column].astype(str) for column in key_columns]))
+        hashes = dict(zip(keys, pd.util.hash_pandas_object(dataframe, index=False).tolist()))
+
+        snapshot = self.snapshots.get(table_name)
+        if snapshot is None and not self.tableHasColumn(table_name, "modified_at"):
+            #first load, or a table written by another mode: rebuild it with the key and timestamps
+            full_df = dataframe.assign(first_seen=now, modified_at=now)
+            self.swapTable(full_df, table_name, primary_key=key_columns)
+            self.snapshots[table_name] = hashes
+            counts = {"inserted": len(keys), "updated": 0, "deleted": 0}
+            print("Upserted {}: {}".format(table_name, counts))
+            return counts
+
+        #make room for longer values, new ENUM values and new columns before writing
+        self.migrateTable(dataframe, table_name, key_columns)
+        if snapshot is None:
+            #the table outlived the process that loaded it. diff against the keys stored in MySQL
+            stored_keys = self.readTable(table_name, select_statement="SELECT `{}` FROM `{}`".format(
+                "`,`".join(key_columns), table_name), toPrint=False)
+            stored_keys = [tuple(str(decodeSql(value)) for value in key) for key in stored_keys]
+            changed = list(range(len(keys)))
+            deleted = [key for key in set(stored_keys) - set(keys)]
+            inserted_count = len(set(keys) - set(stored_keys))
+        else:
+            changed = [i for i, key in enumerate(keys) if snapshot.get(key) != hashes[key]]
+            deleted = [key for key in snapshot if key not in hashes]
+            inserted_count = sum(1 for i in changed if keys[i] not in snapshot)
+
+        rows = [toSqlRow(row) + (now, now) for row in dataframe.iloc[changed].itertuples(index=False, name=None)]
+        cols = "`,`".join(data_columns + ["first_seen", "modified_at"])
+        #modified_at is assigned first so it can compare the old values before they are overwritten
+        value_columns = [column for column in data_columns if column not in key_columns]
+        unchanged = " AND ".join("`{0}` <=> VALUES(`{0}`)".format(column) for column in value_columns) or "TRUE"
+        updates = "".join(", `{0}` = VALUES(`{0}`)".format(column) for column in value_columns)
+        upsert = "INSERT INTO `" + table_name + "` (`" + cols + "`) VALUES (" + "%s," * (len(data_columns)+1) + "%s)" \
+                 " ON DUPLICATE KEY UPDATE `modified_at` = IF(" + unchanged + ", `modified_at`, VALUES(`modified_at`))" + updates
+        delete = "DELETE FROM `" + table_name + "` WHERE " + " AND ".join("`{}` = %s".format(column) for column in key_columns)
+
+        with self.connection() as myconnection:
+            mycursor = myconnection.cursor()
+            try:
+                for i in range(0, len(rows), self.chunk_size):
+                    mycursor.executemany(upsert, rows[i:i + self.chunk_size])
+                    METRICS.increment("sql_round_trips_total", table=table_name)
+                for i in range(0, len(deleted), self.chunk_size):
+                    mycursor.executemany(delete, deleted[i:i + self.chunk_size])
+                    METRICS.increment("sql_round_trips_total", table=table_name)
+                with METRICS.timer("sql_commit_seconds", table=table_name):
+                    myconnection.commit()
+                METRICS.increment("sql_round_trips_total", table=table_name)
+            except mysql_connector.Error:
+                myconnection.rollback()
+                raise
+            finally:
+                mycursor.close()
+
+        self.snapshots[table_name] = hashes
+        counts = {"inserted": inserted_count, "updated": len(rows) - inserted_count, "deleted": len(deleted)}
+        METRICS.increment("sql_rows_written_total", len(rows) + len(deleted), table=table_name)
+        print("Upserted {}: {}".format(table_name, counts))
+        return counts
+
+    def tableHasColumn(self, table_name, column_name):
+        """ Returns True if table_name exists and has a column named column_name """
+        if not self.tableExists(table_name):
+            return False
+        with self.connection() as myconnection:
+            mycursor = myconnection.cursor()
+            mycursor.execute("SHOW COLUMNS FROM `{}` LIKE %s".format(table_name), (column_name.replace("_", "\\_"),))
+            has_column = mycursor.fetchone() is not None
+            mycursor.close()
+        return has_column
+
+    def waitForDrops(self, table_name = None):
+        """ Waits for the background drops started by swapTable (for one table, or all tables if table_name is None) """
+        table_names = [table_name] if table_name is not None else list(self.drop_threads)
+        for name in table_names:
+            drop_thread = self.drop_threads.pop(name, None)
+            if drop_thread is not None:
+                drop_thread.join()
+
+    def getStations(self, table_name, user_name = None, password = None, host = None, port = None, db_name = None):
+        """ Reads the route table created in MySQL. Selects the distinct destinations and
+        parses them using pattern matching to generate the regional station name key.
+        With a station_resolver the names come from its mapping and names the arrivals API rejected are left out.
+        Outputs a list of regional station names"""
+        select_statement = "SELECT DISTINCT destination FROM `" + table_name + "` WHERE destination IS NOT NULL"
+        destinations = [destination[0] for destination in
+                        self.readTable(table_name, select_statement = select_statement, toPrint = False)]
+        return self.resolveStations(destinations)